@@ -1,35 +1,98 @@
 import base64
-import io
 import os
-import shutil
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional, Tuple
 
-import uvicorn
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import (
+    Depends,
+    FastAPI,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Request,
+    UploadFile,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
-from PIL import Image
-
-from bing import bing_search
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from openai import AsyncOpenAI
+from prometheus_client import CONTENT_TYPE_LATEST
+from pydantic import ValidationError
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile as FormFile
+
+from assets import UnknownAsset, get_asset_store, is_asset_ref, parse_asset_ref
+from audio_cache import get_audio_cache
+from bing import bing_search, create_web_client
+from dedup import DEDUP_MAX_DISTANCE, find_near_duplicates
 from helpers import (
-    clean_descriptions,
     create_chat_messages,
-    generateteVideofromimagesandaudio,
+    decode_base64_image,
     process_files_with_descriptions,
 )
-from openai_prompt import example
+from jobs import VIDEO_WORKERS, JobQueueFull, VideoJobManager
+from llm import create_openai_client, get_openai_client
+from markdown_scan import replace_images_with_placeholders, restore_image_placeholders
+from metrics import MetricsMiddleware, metrics_payload, stage_timer
+from preprocess import (
+    IMAGE_WORKERS,
+    MIME_TYPES,
+    VISION_IMAGE_FORMAT,
+    VISION_IMAGE_MAX_SIZE,
+    VISION_IMAGE_QUALITY,
+    create_image_pool,
+    downscale_image,
+    parse_detail,
+    prepare_vision_images,
+)
 from schemas import (
     ImproveTextRequest,
     Instruction,
-    Instructions,
     SearchQuery,
+    VideoJobCreated,
+    VideoJobStatus,
     VideoRequest,
-    VideoResponse,
 )
+from segments import get_segment_cache
+from streaming import SSE_HEADERS, ranged_file_response, sse_event
+from tracing import TracingMiddleware, debug_token_valid, span, trace_store
+from upload_cache import get_upload_cache, upload_cache_key
+from upstream import estimate_tokens, get_limiter, request_key
+from vision import analyze_images, iter_analyze_images
+from warmup import WARM_UP_POOLS, warm_up_pool
+
+load_dotenv()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled async OpenAI client shared by every request of this worker
+    app.state.openai_client = create_openai_client()
+    # Pooled HTTP client for Bing and Jina Reader
+    app.state.web_client = create_web_client()
+    # Video renders run in a process pool, each in its own workspace
+    app.state.video_jobs = VideoJobManager()
+    # Upload preprocessing (decode, downscale, re-encode) is CPU bound
+    app.state.image_pool = create_image_pool()
+    if WARM_UP_POOLS:
+        # Start the pool processes before serving, the video ones also load the video stack
+        await warm_up_pool(app.state.video_jobs.executor, VIDEO_WORKERS)
+        await warm_up_pool(app.state.image_pool, IMAGE_WORKERS, os.getpid)
+    try:
+        yield
+    finally:
+        app.state.image_pool.shutdown(wait=False, cancel_futures=True)
+        app.state.video_jobs.shutdown()
+        await app.state.web_client.aclose()
+        await app.state.openai_client.close()
+
 
 # FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -38,9 +101,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id"],
 )
-
-load_dotenv()
+app.add_middleware(TracingMiddleware)
+# Outermost, so the timings cover every other middleware
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/")
@@ -48,14 +113,126 @@ async def read_root():
     return {"message": "Welcome to the API"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics: pipeline stages, upstream calls, in-flight requests and jobs."""
+    return Response(metrics_payload(), media_type=CONTENT_TYPE_LATEST)
+
+
+def require_debug_token(x_debug_token: Optional[str] = Header(None)):
+    if not debug_token_valid(x_debug_token):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+
+# Plain functions, FastAPI runs them in its thread pool since traces may be read from TRACE_DIR
+@app.get("/debug/traces", dependencies=[Depends(require_debug_token)])
+def list_traces():
+    """Most recent request traces, newest first."""
+    return trace_store.list()
+
+
+@app.get("/debug/traces/{trace_id}", dependencies=[Depends(require_debug_token)])
+def get_trace(trace_id: str, format: Literal["tree", "chrome"] = "tree"):
+    """A request's span tree, or its Chrome trace events with format=chrome."""
+    trace = trace_store.chrome(trace_id) if format == "chrome" else trace_store.tree(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
+
+
+@app.get("/debug/traces/{trace_id}/profile", dependencies=[Depends(require_debug_token)])
+def get_trace_profile(trace_id: str):
+    """CPU profile of a request traced with X-Debug-Trace: profile, as folded stacks."""
+    profile = trace_store.profile(trace_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(profile)
+
+
+# Plain functions, run in the thread pool: the stats read the metric files of every process
+# and list the cache directory
+@app.get("/audio-cache/stats")
+def audio_cache_stats():
+    return get_audio_cache().stats()
+
+
+@app.get("/upload-cache/stats")
+def upload_cache_stats():
+    return get_upload_cache().stats()
+
+
+@app.get("/segment-cache/stats")
+def segment_cache_stats():
+    return get_segment_cache().stats()
+
+
+@app.post("/assets", status_code=201)
+async def upload_assets(files: List[UploadFile] = File(...)):
+    """Store images once and return their ids.
+
+    Identical images get the same id. Pass `ref` ("asset:<id>") instead of a base64 image
+    to /improveText and /generate-video/.
+    """
+    store = get_asset_store()
+    assets = []
+    for idx, file in enumerate(files):
+        content = await file.read()
+        try:
+            assets.append(await run_in_threadpool(store.put_image, content))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image at index {idx}: {str(e)}")
+    return assets
+
+
+@app.get("/assets/{asset_id}")
+async def get_asset(asset_id: str, http_request: Request):
+    """Return a stored image."""
+    store = get_asset_store()
+    try:
+        meta = store.get_meta(asset_id)
+    except UnknownAsset:
+        raise HTTPException(status_code=404, detail="Unknown asset")
+    path = store.path(asset_id)
+    try:
+        if path is None:
+            raise FileNotFoundError(asset_id)
+        return ranged_file_response(
+            path,
+            range_header=http_request.headers.get("range"),
+            media_type=meta["content_type"],
+        )
+    except FileNotFoundError:
+        # Evicted since the lookup
+        raise HTTPException(status_code=404, detail="Unknown asset")
+
+
 @app.post("/search")
-async def search(query: SearchQuery):
-    result = bing_search(query.query)
+async def search(query: SearchQuery, http_request: Request):
+    result = await bing_search(http_request.app.state.web_client, query.query)
     return {"context": result}
 
 
+def asset_vision_data_url(asset_id: str) -> str:
+    # The settings are part of the variant name, changing them does not serve stale copies
+    variant = f"vision-{VISION_IMAGE_MAX_SIZE}-{VISION_IMAGE_FORMAT}-{VISION_IMAGE_QUALITY}"
+    data = get_asset_store().get_variant(asset_id, variant, downscale_image)
+    return f"data:{MIME_TYPES[VISION_IMAGE_FORMAT]};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+async def resolve_image_url(image: str) -> str:
+    """Image URL for the model: inline data URLs pass through, asset refs use the stored downscaled copy."""
+    if not is_asset_ref(image):
+        return image
+    try:
+        return await run_in_threadpool(asset_vision_data_url, parse_asset_ref(image))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except UnknownAsset:
+        raise HTTPException(status_code=404, detail=f"Unknown asset {image}")
+
+
 @app.post("/improveText")
-async def improve_text(request: ImproveTextRequest):
+async def improve_text(request: ImproveTextRequest, client: AsyncOpenAI = Depends(get_openai_client)):
     description = request.description
     improve_text = request.improveText
     image = request.image
@@ -63,17 +240,23 @@ async def improve_text(request: ImproveTextRequest):
     if not description or not improve_text:
         raise HTTPException(status_code=400, detail="Missing content or improvement instructions")
 
+    # Embedded base64 images are swapped for short placeholders and restored afterwards
+    description, image_refs = replace_images_with_placeholders(request.description)
+
     # Create messages for the API call
-    messages = create_chat_messages(description, improve_text, image)
-    
+    messages = create_chat_messages(description, improve_text, await resolve_image_url(image))
 
-    client = OpenAI(
-)
-    # Call OpenAI API
-    response = client.beta.chat.completions.parse(
-    model="gpt-4o",
-    messages=messages,
-    response_format=Instruction)
+    # Call OpenAI API, identical requests in flight share the call
+    response = await get_limiter("openai").run(
+        lambda: client.beta.chat.completions.parse(
+        model="gpt-4o",
+        messages=messages,
+        response_format=Instruction),
+        "improve_text",
+        "gpt-4o",
+        tokens=estimate_tokens(messages, len(description) // 4),
+        key=request_key("gpt-4o", messages),
+    )
 
     json_str = response.choices[0].message.parsed
     print(json_str)
@@ -82,151 +265,473 @@ async def improve_text(request: ImproveTextRequest):
         raise HTTPException(status_code=400, detail="Failed to parse instructions from the response.")
 
     # Extract the improved content
-    improved_content = json_str.page_instruction
+    improved_content = restore_image_placeholders(json_str.page_instruction, request.description, image_refs)
     return {
         'improved_content': improved_content
     }
 
 
+def partial_page_instruction(parsed) -> str:
+    """page_instruction of a partially parsed Instruction, as a dict or model."""
+    if parsed is None:
+        return ""
+    if isinstance(parsed, dict):
+        return parsed.get("page_instruction") or ""
+    return getattr(parsed, "page_instruction", None) or ""
+
+
+@app.post("/improveText/stream")
+async def improve_text_stream(
+    request: ImproveTextRequest,
+    http_request: Request,
+    client: AsyncOpenAI = Depends(get_openai_client),
+):
+    """Stream the improved content as server-sent events while it is generated.
+
+    Emits `delta` events with the newly generated text, then a `done` event with the
+    full content, or an `error` event. Embedded images appear as image://N placeholders in
+    the deltas and are restored in the `done` content. The upstream request is aborted
+    when the client disconnects.
+    """
+    if not request.description or not request.improveText:
+        raise HTTPException(status_code=400, detail="Missing content or improvement instructions")
+
+    description, image_refs = replace_images_with_placeholders(request.description)
+    messages = create_chat_messages(description, request.improveText, await resolve_image_url(request.image))
+
+    limiter = get_limiter("openai")
+    tokens = estimate_tokens(messages, len(description) // 4)
+
+    async def events():
+        sent = ""
+        try:
+            # Transient failures are retried until the first delta has been sent. Leaving the
+            # block (also on cancellation) closes the upstream connection.
+            async with limiter.stream(
+                lambda: client.beta.chat.completions.stream(
+                    model="gpt-4o",
+                    messages=messages,
+                    response_format=Instruction,
+                ),
+                "improve_text_stream",
+                "gpt-4o",
+                tokens,
+                can_retry=lambda: not sent,
+            ) as events:
+                async for event in events:
+                    if await http_request.is_disconnected():
+                        print("Client disconnected, aborting improveText stream")
+                        return
+                    if event.type != "content.delta":
+                        continue
+                    text = partial_page_instruction(event.parsed)
+                    if len(text) > len(sent) and text.startswith(sent):
+                        yield sse_event({"delta": text[len(sent):]}, event="delta")
+                        sent = text
+            completion = events.completion
+
+            json_str = completion.choices[0].message.parsed
+            if json_str is None:
+                yield sse_event({"detail": "Failed to parse instructions from the response."}, event="error")
+                return
+            improved_content = restore_image_placeholders(json_str.page_instruction, request.description, image_refs)
+            yield sse_event({"improved_content": improved_content}, event="done")
+        except Exception as e:
+            print(f"Error streaming improveText: {e}")
+            yield sse_event({"detail": str(e)}, event="error")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
 @app.post("/uploadfiles/")
-async def uploadfiles(files: List[UploadFile] = File(...),additional_prompt: Optional[str] = Form(None)):
+async def uploadfiles(
+    http_request: Request,
+    files: List[UploadFile] = File(...),
+    additional_prompt: Optional[str] = Form(None),
+    detail: Optional[str] = Form(None),
+    no_cache: bool = Form(False),
+    dedup: bool = Form(False),
+    dedup_distance: int = Form(DEDUP_MAX_DISTANCE),
+    stream: bool = Form(False),
+    client: AsyncOpenAI = Depends(get_openai_client),
+):
     """
     Upload multiple files and return their filenames and descriptions.
 
+    With stream=true (or Accept: application/x-ndjson) the response is NDJSON: a `start`
+    record, one `page` record per image as soon as its description is ready (pages may
+    arrive out of order and refer to the uploads by index instead of echoing them), then
+    a `done` or `error` record.
+
     Args:
         files (List[UploadFile]): List of files to be uploaded.
         additional_prompt (Optional[str]): Additional context to be included in the prompt.
+        detail (Optional[str]): Vision detail level (low, high or auto), either one for all
+            images or a comma separated list with one per image.
+        no_cache (bool): Skip the cached instructions and regenerate them (also with Cache-Control: no-cache).
+        dedup (bool): Merge consecutive near-duplicate photos into a single page.
+        dedup_distance (int): Maximum Hamming distance (out of 64 bits) between near-duplicates.
+        stream (bool): Stream the pages as NDJSON.
 
     Returns:
         dict: A dictionary containing the filenames of the uploaded files and descriptions.
     """
-    filenames = [file.filename for file in files]
-    
-    # Process uploaded files and convert them to base64
-    images_b64 = []
-    for file in files:
-        content = await file.read()
-        images_b64.append(base64.b64encode(content).decode("utf-8"))
-    
-    # Create a prompt for OpenAI using the filenames
-    prompt =f"""I uploaded {len(filenames)} images. These images provide visual instructions for assembling an object. Please analyze each image carefully and generate a clear, concise set of assembly instructions. 
-    For each image, provide the following description: Create a detailed instruction in Markdown format that describes what the user should do based on the visual information presented in the corresponding image. 
-    Output Format: The response should be structured as a list, where each element is a string that contains the Markdown-formatted instruction for that particular image. IMPORTANT: 1 exact description per image. So the list should be of length {len(filenames)}. 
-    
-    An example is provided below:
-    
-    Input: 2 images of a paper airplane construction.
-    Output: list of lenght = 2 containing the description of each step. eg: {example}
-
-
-    Additional context that may be helpful: {additional_prompt}
-    """
+    try:
+        details = parse_detail(detail, len(files))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Process uploaded files and convert them to base64, the originals go back to the editor
+    with span("read_uploads", files=len(files)):
+        images = [await file.read() for file in files]
+
+    # Bursts of near-identical photos become a single page
+    groups = None
+    if dedup:
+        try:
+            with stage_timer("dedup"):
+                dedup_result = await find_near_duplicates(http_request.app.state.image_pool, images, dedup_distance)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+        groups = dedup_result.groups
+        images = [images[idx] for idx in dedup_result.representatives]
+        details = [details[idx] for idx in dedup_result.representatives]
+        print(f"Dedup kept {len(images)} of {len(files)} uploads: {groups}")
+
+    # Upload index of each page, so streamed pages can refer to the client's own files
+    upload_indices = [group[0] for group in groups] if groups is not None else list(range(len(images)))
+
+    # Repeat uploads of the same images and prompt are answered from the cache
+    cache = get_upload_cache()
+    with span("upload_cache_lookup"):
+        cache_key = await run_in_threadpool(upload_cache_key, images, additional_prompt, details)
+        bypass_cache = no_cache or "no-cache" in http_request.headers.get("cache-control", "")
+        instructions = None if bypass_cache else await run_in_threadpool(cache.get, cache_key)
+
+    vision_images = None
+    if instructions is None:
+        # The model gets downscaled copies, prepared across cores
+        try:
+            with stage_timer("preprocess"):
+                vision_images = await prepare_vision_images(http_request.app.state.image_pool, images, details)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {str(e)}")
+        print(f"Vision payload: {sum(image.size for image in vision_images)} bytes "
+              f"(uploads: {sum(len(content) for content in images)} bytes)")
+
+    if stream or "application/x-ndjson" in http_request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_upload_pages(client, vision_images, instructions, additional_prompt, upload_indices, groups, cache, cache_key),
+            media_type="application/x-ndjson",
+            headers={"X-Accel-Buffering": "no"},
+        )
 
-    print(prompt)
+    if instructions is None:
+        # One model call per window of images, windows run concurrently
+        try:
+            with stage_timer("vision"):
+                instructions = await analyze_images(client, vision_images, additional_prompt)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        print(instructions)
+        await run_in_threadpool(cache.put, cache_key, instructions)
+
+    with stage_timer("base64_encode"):
+        images_b64 = [base64.b64encode(content).decode("utf-8") for content in images]
+    imgsWithDescr = process_files_with_descriptions(images_b64,instructions)
+    if groups is not None:
+        # Report which uploads were merged into each page
+        for page, group in zip(imgsWithDescr, groups):
+            page["merged_uploads"] = group
+    return orjson_response(imgsWithDescr)
 
-    
-    client = OpenAI(
-    )
-    # Make a call to OpenAI's API to get a description
-    response = client.beta.chat.completions.parse(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/png; base64,{images_b64}" },
+
+def orjson_response(content) -> Response:
+    """JSON response serialised by orjson, which writes large base64 strings straight to bytes."""
+    return Response(orjson.dumps(content), media_type="application/json")
+
+
+def ndjson_record(record: dict) -> bytes:
+    return orjson.dumps(record) + b"\n"
+
+
+async def stream_upload_pages(client, vision_images, instructions, additional_prompt, upload_indices, groups, cache, cache_key):
+    """NDJSON records for /uploadfiles/, one page per record as descriptions complete."""
+    yield ndjson_record({"type": "start", "pages": len(upload_indices)})
+
+    def page_record(index, description):
+        record = {"type": "page", "index": index, "upload_index": upload_indices[index], "description": description}
+        if groups is not None:
+            record["merged_uploads"] = groups[index]
+        return ndjson_record(record)
+
+    if instructions is not None:
+        for index, description in enumerate(instructions):
+            yield page_record(index, description)
+        yield ndjson_record({"type": "done", "cached": True})
+        return
+
+    collected = [None] * len(upload_indices)
+    try:
+        with stage_timer("vision"):
+            async for index, description in iter_analyze_images(client, vision_images, additional_prompt):
+                collected[index] = description
+                yield page_record(index, description)
+    except Exception as e:
+        print(f"Error streaming upload pages: {e}")
+        yield ndjson_record({"type": "error", "detail": str(e)})
+        return
+
+    await run_in_threadpool(cache.put, cache_key, collected)
+    yield ndjson_record({"type": "done", "cached": False})
+
+
+def get_video_jobs(request: Request) -> VideoJobManager:
+    return request.app.state.video_jobs
+
+
+VIDEO_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": VideoRequest.model_json_schema()},
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["images", "descriptions"],
+                    "properties": {
+                        "images": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                        "descriptions": {"type": "array", "items": {"type": "string"}},
+                        "batch_cleaning": {"type": "boolean"},
+                        "response_mode": {"type": "string", "enum": ["file", "base64"]},
                     },
-                ],
-            }
-        
-        ],
-        response_format=Instructions,
-    )
+                }
+            },
+        },
+    }
+}
 
-    json_str = response.choices[0].message.parsed
 
-    # Access the list of instructions
-    if json_str is None:
-        raise HTTPException(status_code=400, detail="Failed to parse instructions from the response.")
-    instructions = json_str.pages_instructions
-    print(instructions)
-    imgsWithDescr = process_files_with_descriptions(images_b64,instructions)
-    return  imgsWithDescr
-
-
-@app.post("/generate-video/")
-async def generate_video(request: VideoRequest):
-    """Generate a video and return it as base64 data URL."""
-
-    
-    output_dir = "./output"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    temp_dir = os.path.join(output_dir, f"temp_{os.getpid()}")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-        
-    saved_files = []
-
-    ## First, we enhance the descriptions using OpenAI
-    cleaned_descriptions = clean_descriptions(request.descriptions)
-    
+async def read_video_request(http_request: Request) -> Tuple[VideoRequest, Optional[List[bytes]]]:
+    """Parse a video request sent as JSON (base64 images) or multipart (binary image parts).
+
+    Returns:
+        The request options, and the raw image bytes for multipart requests.
+    """
+    content_type = http_request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = None
+        try:
+            with span("read_multipart"):
+                form = await http_request.form()
+                files = form.getlist("images")
+                for idx, file in enumerate(files):
+                    if not isinstance(file, FormFile):
+                        raise HTTPException(status_code=400, detail=f"Image at index {idx} must be a file upload")
+                images = [await file.read() for file in files]
+            batch_cleaning = form.get("batch_cleaning", "false")
+            if not isinstance(batch_cleaning, str):
+                raise HTTPException(status_code=400, detail="batch_cleaning must be a form field, not a file")
+            try:
+                request = VideoRequest(
+                    images=[],
+                    descriptions=form.getlist("descriptions"),
+                    batch_cleaning=batch_cleaning.lower() in ("1", "true", "on", "yes"),
+                    response_mode=form.get("response_mode", "file"),
+                )
+            except ValidationError as e:
+                raise RequestValidationError(e.errors())
+        finally:
+            # Releases the temp files of spooled uploads
+            if form is not None:
+                await form.close()
+        return request, images
+
+    # Validate straight from the raw body, without building an intermediate dict of huge strings
+    try:
+        with span("read_body"):
+            body = await http_request.body()
+        with span("validate_request", bytes=len(body)):
+            return VideoRequest.model_validate_json(body), None
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+
+async def submit_video_job(
+    request: VideoRequest,
+    client: AsyncOpenAI,
+    video_jobs: VideoJobManager,
+    images: Optional[List[bytes]] = None,
+) -> str:
+    """Decode the request images and queue a render, returning the job id.
+
+    Binary images from multipart requests are passed as `images` and used as they are.
+    """
+    if images is None:
+        with stage_timer("decode_images"):
+            images = await decode_request_images(request.images)
+
     try:
-        # Process and save each base64 image
-        for idx, base64_str in enumerate(request.images):
+        return await video_jobs.submit(client, images, request.descriptions, batch_cleaning=request.batch_cleaning)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def decode_request_images(refs: List[str]) -> List[bytes]:
+    """Image bytes for base64 strings and asset refs."""
+    images = []
+    store = get_asset_store()
+    for idx, base64_str in enumerate(refs):
+        if is_asset_ref(base64_str):
+            # The renderer decodes any stored format directly, no transcoding needed
             try:
-                if ',' in base64_str:
-                    base64_str = base64_str.split(',')[1]
-                
-                image_data = base64.b64decode(base64_str)
-                image = Image.open(io.BytesIO(image_data))
-                file_path = os.path.join(temp_dir, f"image_{idx}.png")
-                image.save(file_path, 'PNG')
-                saved_files.append(file_path)
-                
+                images.append(await run_in_threadpool(store.get_image, parse_asset_ref(base64_str)))
+            except UnknownAsset:
+                raise HTTPException(status_code=404, detail=f"Unknown asset at index {idx}: {base64_str}")
             except Exception as e:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Invalid base64 image at index {idx}: {str(e)}"
-                )
+                raise HTTPException(status_code=400, detail=f"Invalid asset at index {idx}: {str(e)}")
+            continue
+        try:
+            images.append(decode_base64_image(base64_str))
+        except Exception as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid base64 image at index {idx}: {str(e)}"
+            )
+    return images
 
-        # Generate the video
-        output_path = generateteVideofromimagesandaudio(
-            pngs=saved_files,
-            descriptions=cleaned_descriptions
-        )
 
-        # Convert video to base64
-        if os.path.exists(output_path):
-            with open(output_path, "rb") as video_file:
-                video_base64 = base64.b64encode(video_file.read()).decode('utf-8')
-                video_data_url = f"data:video/mp4;base64,{video_base64}"
-                
-            return VideoResponse(video=video_data_url)
-        else:
+@app.post("/video-jobs", response_model=VideoJobCreated, status_code=202, openapi_extra=VIDEO_REQUEST_BODY)
+async def create_video_job(
+    http_request: Request,
+    client: AsyncOpenAI = Depends(get_openai_client),
+    video_jobs: VideoJobManager = Depends(get_video_jobs),
+):
+    """Queue a video render and return immediately with the job id.
+
+    Accepts the same JSON or multipart body as /generate-video/.
+    """
+    request, images = await read_video_request(http_request)
+    job_id = await submit_video_job(request, client, video_jobs, images)
+    return VideoJobCreated(
+        job_id=job_id,
+        status_url=f"/video-jobs/{job_id}",
+        result_url=f"/video-jobs/{job_id}/result",
+    )
+
+
+@app.get("/video-jobs/{job_id}", response_model=VideoJobStatus)
+async def video_job_status(job_id: str, video_jobs: VideoJobManager = Depends(get_video_jobs)):
+    """Report the status and current pipeline stage of a video job."""
+    status = video_jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown video job")
+    return status
+
+
+@app.get("/video-jobs/{job_id}/result")
+async def video_job_result(
+    job_id: str,
+    http_request: Request,
+    cleanup: bool = False,
+    video_jobs: VideoJobManager = Depends(get_video_jobs),
+):
+    """Stream the rendered video of a finished job, with HTTP Range support for seeking.
+
+    With cleanup=true the job and its files are deleted once the response has been sent.
+    """
+    status = video_jobs.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown video job")
+    if status["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Error generating video: {status['error']}")
+    if status["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Video job is still {status['status']}")
+    return ranged_file_response(
+        video_jobs.get(job_id)["result_path"],
+        range_header=http_request.headers.get("range"),
+        media_type="video/mp4",
+        filename="video.mp4",
+        background=BackgroundTask(video_jobs.remove, job_id) if cleanup else None,
+    )
+
+
+@app.delete("/video-jobs/{job_id}", status_code=204)
+async def delete_video_job(job_id: str, video_jobs: VideoJobManager = Depends(get_video_jobs)):
+    """Delete a job and its files."""
+    if video_jobs.status(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown video job")
+    video_jobs.remove(job_id)
+
+
+def read_video_data_url(path: str) -> str:
+    with open(path, "rb") as video_file:
+        video_base64 = base64.b64encode(video_file.read()).decode('utf-8')
+    return f"data:video/mp4;base64,{video_base64}"
+
+
+@app.post("/generate-video/", openapi_extra=VIDEO_REQUEST_BODY)
+async def generate_video(
+    http_request: Request,
+    client: AsyncOpenAI = Depends(get_openai_client),
+    video_jobs: VideoJobManager = Depends(get_video_jobs),
+):
+    """Generate a video and stream it back as an mp4 file.
+
+    The body is either a JSON VideoRequest with base64 images, or multipart/form-data with
+    binary `images` parts and repeated `descriptions` fields in the same order.
+    With response_mode="base64" the video is returned as a base64 data URL in JSON instead.
+    """
+    request, images = await read_video_request(http_request)
+    job_id = await submit_video_job(request, client, video_jobs, images)
+    streaming = False
+    try:
+        job = await video_jobs.wait(job_id)
+        if job["status"] != "done":
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error generating video: {job['error']}"
+            )
+        if not os.path.exists(job["result_path"]):
             raise HTTPException(
                 status_code=500,
                 detail="Video generation failed - output file not found"
             )
 
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error generating video: {str(e)}"
+        if request.response_mode == "base64":
+            # Convert video to base64
+            with stage_timer("base64_encode"):
+                video_data_url = await run_in_threadpool(read_video_data_url, job["result_path"])
+            return orjson_response({"video": video_data_url})
+
+        # The workspace is removed once the file has been sent
+        response = ranged_file_response(
+            job["result_path"],
+            range_header=http_request.headers.get("range"),
+            media_type="video/mp4",
+            filename="generated_video.mp4",
+            background=BackgroundTask(video_jobs.remove, job_id),
         )
-    
+        streaming = True
+        return response
+
     finally:
-        # Clean up temporary files
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        if os.path.exists(output_path):
-            os.remove(output_path)
+        # Clean up the job workspace
+        if not streaming:
+            video_jobs.remove(job_id)
 
-# Run the FastAPI server
+# Run the FastAPI server: preforked production workers, or --reload for development
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reload", action="store_true", help="Single development server restarting on code changes")
+    args = parser.parse_args()
+    if args.reload:
+        import uvicorn
+        uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
+    else:
+        os.execvp(sys.executable, [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "api:app"])
\ No newline at end of file
@@ -0,0 +1,114 @@
+import hashlib
+import io
+import os
+import re
+import threading
+from typing import Callable, Optional
+
+from PIL import Image
+
+from disk_cache import DiskCache
+
+ASSET_STORE_DIR = os.getenv("ASSET_STORE_DIR", "./output/assets")
+ASSET_STORE_MAX_BYTES = int(os.getenv("ASSET_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+ASSET_REF_PREFIX = "asset:"
+ASSET_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UnknownAsset(KeyError):
+    pass
+
+
+def is_asset_ref(value: str) -> bool:
+    return value.startswith(ASSET_REF_PREFIX)
+
+
+def parse_asset_ref(value: str) -> str:
+    """Asset id of an "asset:<sha256>" reference."""
+    asset_id = value[len(ASSET_REF_PREFIX):]
+    if not ASSET_ID_PATTERN.match(asset_id):
+        raise ValueError(f"Invalid asset reference '{value}'")
+    return asset_id
+
+
+class AssetStore(DiskCache):
+    """Content-addressed image store with LRU eviction.
+
+    Images are stored once under the sha256 of their bytes. Derived variants (e.g. the
+    downscaled copy sent to the vision model) are computed on first use and stored next
+    to the original, so decoding and transcoding happen once per asset.
+    """
+
+    name = "assets"
+
+    def __init__(self, directory: str = ASSET_STORE_DIR, max_bytes: int = ASSET_STORE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def put_image(self, data: bytes) -> dict:
+        """Store an image, returning its id and properties. Re-uploads are not written again."""
+        asset_id = hashlib.sha256(data).hexdigest()
+        entry = self.get(asset_id)
+        if entry is not None:
+            return self._describe(asset_id, entry[1])
+
+        # Only parses the header
+        with Image.open(io.BytesIO(data)) as image:
+            meta = {
+                "content_type": Image.MIME.get(image.format, "application/octet-stream"),
+                "width": image.width,
+                "height": image.height,
+            }
+        self.put(asset_id, data, meta)
+        return self._describe(asset_id, {**meta, "size": len(data)})
+
+    @staticmethod
+    def _describe(asset_id: str, meta: dict) -> dict:
+        return {
+            "asset_id": asset_id,
+            "ref": f"{ASSET_REF_PREFIX}{asset_id}",
+            "content_type": meta["content_type"],
+            "width": meta["width"],
+            "height": meta["height"],
+            "size": meta["size"],
+        }
+
+    def get_image(self, asset_id: str) -> bytes:
+        entry = self.get(asset_id)
+        if entry is None:
+            raise UnknownAsset(asset_id)
+        return entry[0]
+
+    def get_meta(self, asset_id: str) -> dict:
+        meta = self._read_meta(asset_id) if ASSET_ID_PATTERN.match(asset_id) else None
+        if meta is None:
+            raise UnknownAsset(asset_id)
+        return self._describe(asset_id, meta)
+
+    def get_variant(self, asset_id: str, variant: str, transform: Callable[[bytes], bytes]) -> bytes:
+        """Return a derived version of an asset, computing and storing it on first use."""
+        key = f"{asset_id}.{variant}"
+        entry = self.get(key)
+        if entry is not None:
+            return entry[0]
+        data = transform(self.get_image(asset_id))
+        self.put(key, data, {"variant": variant})
+        return data
+
+    def path(self, asset_id: str) -> Optional[str]:
+        meta = self._read_meta(asset_id)
+        if meta is None:
+            return None
+        return os.path.join(self.directory, meta["file"])
+
+
+_asset_store = None
+_asset_store_lock = threading.Lock()
+
+
+def get_asset_store() -> AssetStore:
+    """Return the process-wide asset store."""
+    global _asset_store
+    with _asset_store_lock:
+        if _asset_store is None:
+            _asset_store = AssetStore()
+        return _asset_store
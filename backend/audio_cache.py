@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from disk_cache import DiskCache
+from tts import SynthesizedAudio
+
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "./output/audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+
+
+def audio_cache_key(text: str, voice_name: str, language: str, output_format: str) -> str:
+    """Content address of a narration clip."""
+    payload = json.dumps([text, voice_name, language, output_format], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AudioCache(DiskCache):
+    """Size-capped LRU cache of synthesized narration clips.
+
+    The sidecar of each clip stores its duration, so a hit needs neither a TTS call
+    nor an audio decode.
+    """
+
+    name = "audio"
+
+    def __init__(self, directory: str = AUDIO_CACHE_DIR, max_bytes: int = AUDIO_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def get(self, key: str) -> Optional[SynthesizedAudio]:
+        entry = super().get(key)
+        if entry is None:
+            return None
+        audio, meta = entry
+        return SynthesizedAudio(audio, meta["duration_ms"], meta["format"])
+
+    def put(self, key: str, clip: SynthesizedAudio):
+        super().put(key, clip.audio, {"duration_ms": clip.duration_ms, "format": clip.format}, suffix=f".{clip.format}")
+
+
+_audio_cache = None
+_audio_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache:
+    """Return the process-wide audio cache."""
+    global _audio_cache
+    with _audio_cache_lock:
+        if _audio_cache is None:
+            _audio_cache = AudioCache()
+        return _audio_cache
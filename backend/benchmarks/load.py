@@ -0,0 +1,307 @@
+"""End-to-end load test of the API against local stand-ins for its upstream services.
+
+Starts stand-ins for OpenAI and Bing/Jina Reader, runs the API with uvicorn in a child
+process pointed at them (with the stub speech backend in place of Azure Speech), and
+drives /uploadfiles/, /improveText, /search and /generate-video/ at increasing
+concurrency with the images in test_images/. The JSON report holds, per endpoint and
+concurrency level, the p50/p95/p99 latency, requests per second, errors and the peak
+RSS of the API process tree, so runs can be compared between commits. Run from the
+backend directory:
+
+    python -m benchmarks.load --concurrency 1 4 16 --requests 32 --latency 0.2 --output load.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import httpx
+
+from benchmarks.standins import BackgroundServer, make_openai_app, make_search_app
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_IMAGES_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "test_images")
+ENDPOINTS = ["uploadfiles", "improveText", "search", "generate-video"]
+CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+
+
+def load_test_images():
+    """(filename, bytes, content type) of every image in test_images/."""
+    images = []
+    for filename in sorted(os.listdir(TEST_IMAGES_DIR)):
+        content_type = CONTENT_TYPES.get(os.path.splitext(filename)[1].lower())
+        if content_type:
+            with open(os.path.join(TEST_IMAGES_DIR, filename), "rb") as f:
+                images.append((filename, f.read(), content_type))
+    return images
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident memory of a process and all its descendants, in bytes (Linux only)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, the fields after it do not
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Samples the RSS of a process tree on a background thread and keeps the peak."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def reset(self) -> int:
+        """Return the peak since the last reset and start a new measurement."""
+        peak, self.peak = self.peak, process_tree_rss(self.pid)
+        return max(peak, self.peak)
+
+    def __enter__(self):
+        if sys.platform.startswith("linux"):
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+
+
+def make_requests(images):
+    """Request builders per endpoint. Every request varies with its index so caches do not short-circuit it."""
+    first_data_url = f"data:{images[0][2]};base64,{base64.b64encode(images[0][1]).decode('ascii')}"
+
+    async def uploadfiles(client: httpx.AsyncClient, idx: int):
+        files = [("files", image) for image in images]
+        data = {"additional_prompt": f"Load test run {idx}", "no_cache": "true"}
+        return await client.post("/uploadfiles/", files=files, data=data)
+
+    async def improve_text(client: httpx.AsyncClient, idx: int):
+        body = {
+            "description": f"## Step {idx}\nRemove the cover and set the screws aside.",
+            "improveText": "Make it clearer for a beginner.",
+            "image": first_data_url,
+        }
+        return await client.post("/improveText", json=body)
+
+    async def search(client: httpx.AsyncClient, idx: int):
+        return await client.post("/search", json={"query": f"how to replace a bike chain {idx}"})
+
+    async def generate_video(client: httpx.AsyncClient, idx: int):
+        files = [("images", image) for image in images]
+        data = {"descriptions": [f"Step {page + 1} of run {idx}: follow the picture." for page in range(len(images))]}
+        return await client.post("/generate-video/", files=files, data=data)
+
+    return {
+        "uploadfiles": uploadfiles,
+        "improveText": improve_text,
+        "search": search,
+        "generate-video": generate_video,
+    }
+
+
+def percentile(sorted_values, p: float):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+async def run_level(client: httpx.AsyncClient, send, concurrency: int, n_requests: int, first_idx: int = 0) -> dict:
+    """Send n_requests with `concurrency` requests in flight at all times (closed loop).
+
+    Requests are numbered from first_idx, so no two requests of a run are identical.
+    """
+    latencies = []
+    status_codes = Counter()
+    next_idx = 0
+
+    async def worker():
+        nonlocal next_idx
+        while next_idx < n_requests:
+            idx = next_idx
+            next_idx += 1
+            start = time.perf_counter()
+            try:
+                response = await send(client, first_idx + idx)
+                status_codes[str(response.status_code)] += 1
+                if response.status_code < 400:
+                    latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError as e:
+                status_codes[type(e).__name__] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "ok": len(latencies),
+        "errors": n_requests - len(latencies),
+        "status_codes": dict(status_codes),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 3) if elapsed else None,
+        "latency_ms": {
+            name: None if value is None else round(value * 1000, 1)
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p95", percentile(latencies, 95)),
+                ("p99", percentile(latencies, 99)),
+                ("max", latencies[-1] if latencies else None),
+            )
+        },
+    }
+
+
+def start_api(env: dict, port: int, timeout: float = 60) -> subprocess.Popen:
+    """Run the API with uvicorn in a child process and wait until it answers."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The API exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                return process
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The API did not start in time")
+
+
+def git_commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode().strip() or None
+
+
+async def drive(base_url: str, endpoints, levels, n_requests: int, sampler: RssSampler) -> dict:
+    requests = make_requests(load_test_images())
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(600), limits=httpx.Limits(max_connections=None)) as client:
+        for name in endpoints:
+            results[name] = []
+            for level_idx, concurrency in enumerate(levels):
+                sampler.reset()
+                level = await run_level(client, requests[name], concurrency, n_requests, level_idx * n_requests)
+                level["peak_rss_bytes"] = sampler.reset() or None
+                print(f"{name} c={concurrency}: {level['requests_per_second']} req/s, "
+                      f"p50 {level['latency_ms']['p50']} ms, {level['errors']} errors", file=sys.stderr)
+                results[name].append(level)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="Requests per endpoint and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.2, help="OpenAI, Bing and Jina stand-in latency in seconds")
+    parser.add_argument("--speech-latency", type=float, default=0.1, help="Stub speech latency per clip in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of failing upstream calls")
+    parser.add_argument("--upstream-max-in-flight", type=int, default=0,
+                        help="Concurrent OpenAI and Bing calls beyond it get a 429, 0 for no limit")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    openai_app = make_openai_app(latency=args.latency, error_rate=args.error_rate, max_in_flight=args.upstream_max_in_flight)
+    search_app = make_search_app(latency=args.latency, error_rate=args.error_rate, max_in_flight=args.upstream_max_in_flight)
+    with tempfile.TemporaryDirectory() as data_dir, BackgroundServer(openai_app) as openai_server, \
+            BackgroundServer(search_app) as search_server:
+        env = {
+            **os.environ,
+            "OPENAI_BASE_URL": f"{openai_server.url}/v1",
+            "OPENAI_API_KEY": "stand-in",
+            "BING_ENDPOINT": f"{search_server.url}/v7.0/search",
+            "BING_API_KEY": "stand-in",
+            "JINA_READER_URL": f"{search_server.url}/reader/",
+            "SPEECH_BACKEND": "stub",
+            "STUB_SPEECH_LATENCY": str(args.speech_latency),
+            "STUB_SPEECH_ERROR_RATE": str(args.error_rate),
+            # Fresh caches and workspaces for every run
+            "AUDIO_CACHE_DIR": os.path.join(data_dir, "audio_cache"),
+            "UPLOAD_CACHE_DIR": os.path.join(data_dir, "upload_cache"),
+            "SEGMENT_CACHE_DIR": os.path.join(data_dir, "segment_cache"),
+            "ASSET_STORE_DIR": os.path.join(data_dir, "assets"),
+            "VIDEO_JOBS_DIR": os.path.join(data_dir, "jobs"),
+        }
+        port = free_port()
+        api = start_api(env, port)
+        try:
+            with RssSampler(api.pid) as sampler:
+                started_at = time.time()
+                results = asyncio.run(
+                    drive(f"http://127.0.0.1:{port}", args.endpoints, args.concurrency, args.requests, sampler)
+                )
+        finally:
+            api.terminate()
+            api.wait(timeout=30)
+
+    report = {
+        "commit": git_commit(),
+        "started_at": started_at,
+        "config": vars(args),
+        "upstream_requests": {"openai": openai_app.state.requests, "search": search_app.state.requests},
+        "upstream_rate_limited": {"openai": openai_app.state.rate_limited, "search": search_app.state.rate_limited},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
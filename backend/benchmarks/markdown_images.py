@@ -0,0 +1,92 @@
+"""Compare the single-pass markdown image scanner with the old double regex pass.
+
+Builds synthetic documents of pages with embedded multi-megabyte base64 images, as
+separate lines and all on one line, and reports time per document size and layout as JSON. Run from the backend directory:
+
+    python -m benchmarks.markdown_images --sizes 1,10,100,500
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import time
+import tracemalloc
+
+from markdown_scan import iter_image_refs, scan_markdown
+
+IMAGE_PATTERN = r'!\[(.*?)\]\((data:image\/[^;]+;base64,[^)]+)\)'
+MB = 1024 * 1024
+
+
+def regex_extract(content):
+    """The previous extract_images_from_markdown: findall, then finditer."""
+    matches = re.findall(IMAGE_PATTERN, content)
+    if not matches:
+        return []
+    return [match.group(0) for match in re.finditer(IMAGE_PATTERN, content)]
+
+
+def synthetic_document(size_mb: float, image_kb: int = 2048, single_line: bool = False) -> str:
+    """Markdown pages of text, each embedding one base64 image, totalling about size_mb.
+
+    With single_line, the pages are joined without newlines, as in documents pasted from
+    HTML where every image sits on one long line.
+    """
+    # At least four pages, even for small documents
+    image_kb = int(min(image_kb, max(16, size_mb * 1024 / 4)))
+    payload = base64.b64encode(os.urandom(image_kb * 1024 * 3 // 4)).decode("ascii")
+    page = ("## Step {n}\nFold the paper along the crease and press firmly.\n\n"
+            "![step {n}](data:image/png;base64," + payload + ")\n\n")
+    if single_line:
+        page = page.replace("\n", " ")
+    pages = max(1, int(size_mb * MB) // len(page))
+    return "".join(page.replace("{n}", str(n)) for n in range(pages))
+
+
+def measure(fn, content, trace_memory: bool):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(content)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1,10,100,500", help="document sizes in MB, comma separated")
+    parser.add_argument("--image-kb", type=int, default=2048, help="size of each embedded image, smaller means more images")
+    parser.add_argument("--memory", action="store_true", help="also report peak allocations (slower)")
+    args = parser.parse_args()
+
+    results = []
+    cases = [(float(size), single_line) for size in args.sizes.split(",") for single_line in (False, True)]
+    for size_mb, single_line in cases:
+        content = synthetic_document(size_mb, args.image_kb, single_line)
+        regex_time, regex_peak, regex_images = measure(regex_extract, content, args.memory)
+        scan_time, scan_peak, refs = measure(lambda c: list(iter_image_refs(c)), content, args.memory)
+        segments_time, _, segments = measure(scan_markdown, content, False)
+        assert len(refs) == len(regex_images)
+        del regex_images
+        results.append({
+            "size_mb": round(len(content) / MB, 1),
+            "layout": "single_line" if single_line else "pages",
+            "images": len(refs),
+            "segments": len(segments),
+            "regex_seconds": round(regex_time, 4),
+            "scan_seconds": round(scan_time, 4),
+            "tokenize_seconds": round(segments_time, 4),
+            "speedup": round(regex_time / scan_time, 1) if scan_time else None,
+            "regex_peak_bytes": regex_peak,
+            "scan_peak_bytes": scan_peak,
+        })
+        print(json.dumps(results[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Check that the shared async OpenAI client keeps many calls in flight.
+
+Run from the backend directory:
+
+    python -m benchmarks.openai_concurrency --requests 50 --latency 0.5
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from benchmarks.standins import BackgroundServer, make_openai_app
+from helpers import clean_descriptions
+from llm import create_openai_client
+
+
+async def run(base_url: str, n_requests: int) -> float:
+    client = create_openai_client(base_url=f"{base_url}/v1", api_key="stand-in")
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(clean_descriptions(client, [f"step {i}"]) for i in range(n_requests)))
+        return time.perf_counter() - start
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    app = make_openai_app(latency=args.latency)
+    with BackgroundServer(app) as server:
+        elapsed = asyncio.run(run(server.url, args.requests))
+
+    serial = args.requests * args.latency
+    print(f"{args.requests} calls in {elapsed:.2f}s (serial would be {serial:.2f}s), "
+          f"max in flight upstream: {app.state.max_in_flight}")
+    # Calls must overlap: the whole batch should take a few upstream latencies, not n of them
+    if elapsed > max(4 * args.latency, serial / 4):
+        print("FAIL: upstream calls were not issued concurrently")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Local stand-in servers for the upstream services used by the backend."""
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+
+def _count_images(messages):
+    count = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            count += sum(1 for part in content if part.get("type") == "image_url")
+    return max(count, 1)
+
+
+def _structured_payload(body):
+    """Build a payload matching the pydantic response_format of the request."""
+    schema_name = body.get("response_format", {}).get("json_schema", {}).get("name")
+    if schema_name == "Instructions":
+        n = _count_images(body.get("messages", []))
+        return {"pages_instructions": [f"## Step {i + 1}\nDo the thing shown in image {i + 1}." for i in range(n)]}
+    if schema_name == "Instruction":
+        return {"page_instruction": "## Improved step\nA clearer description of the step."}
+    if schema_name == "CleanedText":
+        text = body["messages"][-1]["content"]
+        return {"cleaned_text": f"Now, {text}"}
+    if schema_name == "CleanedTexts":
+        texts = body["messages"][-1]["content"].split("### Text ")[1:]
+        return {"cleaned_texts": [f"Now, {text.split(chr(10), 1)[-1].strip()}" for text in texts]}
+    return {"text": "ok"}
+
+
+def _upstream_error(error_rate: float):
+    """A 503 response for a random share of the calls, like an overloaded upstream."""
+    if error_rate and random.random() < error_rate:
+        return JSONResponse(
+            {"error": {"message": "The server is overloaded.", "type": "server_error", "code": None}},
+            status_code=503,
+        )
+    return None
+
+
+def _rate_limited(app: FastAPI, max_in_flight: int):
+    """A 429 with Retry-After when more than max_in_flight requests are being served (0 for no limit)."""
+    if max_in_flight and app.state.in_flight >= max_in_flight:
+        app.state.rate_limited += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached.", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+    return None
+
+
+def make_openai_app(latency: float = 0.0, error_rate: float = 0.0, max_in_flight: int = 0) -> FastAPI:
+    """Create a stand-in for the OpenAI chat completions API.
+
+    Args:
+        latency (float): Seconds to wait before answering each request.
+        error_rate (float): Share of the requests answered with a 503.
+        max_in_flight (int): Concurrent requests beyond it are answered with a 429, 0 for no limit.
+
+    Returns:
+        FastAPI: An app answering POST /v1/chat/completions with valid structured outputs.
+    """
+    app = FastAPI()
+    app.state.in_flight = 0
+    app.state.max_in_flight = 0
+    app.state.requests = 0
+    app.state.rate_limited = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        limited = _rate_limited(app, max_in_flight)
+        if limited is not None:
+            return limited
+        app.state.in_flight += 1
+        app.state.max_in_flight = max(app.state.max_in_flight, app.state.in_flight)
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            app.state.in_flight -= 1
+        error = _upstream_error(error_rate)
+        if error is not None:
+            return error
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": json.dumps(_structured_payload(body))},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        }
+
+    return app
+
+
+def make_search_app(latency: float = 0.0, error_rate: float = 0.0, page_chars: int = 20000, max_in_flight: int = 0) -> FastAPI:
+    """Create a stand-in for the Bing Web Search API and the Jina Reader.
+
+    Point BING_ENDPOINT at {url}/v7.0/search and JINA_READER_URL at {url}/reader/.
+
+    Args:
+        latency (float): Seconds to wait before answering each request.
+        error_rate (float): Share of the requests answered with a 503.
+        page_chars (int): Length of each page returned by the reader.
+        max_in_flight (int): Concurrent searches beyond it are answered with a 429, 0 for no limit.
+    """
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.in_flight = 0
+    app.state.rate_limited = 0
+
+    @app.get("/v7.0/search")
+    async def search(q: str, count: int = 10):
+        app.state.requests += 1
+        limited = _rate_limited(app, max_in_flight)
+        if limited is not None:
+            return limited
+        app.state.in_flight += 1
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            app.state.in_flight -= 1
+        error = _upstream_error(error_rate)
+        if error is not None:
+            return error
+        query = q.split(" -site:")[0]
+        return {
+            "_type": "SearchResponse",
+            "webPages": {
+                "value": [
+                    {
+                        "name": f"Result {idx + 1} for {query}",
+                        "url": f"https://example.com/{uuid.uuid4().hex}",
+                        "snippet": f"How to {query}, explained step by step ({idx + 1}).",
+                    }
+                    for idx in range(count)
+                ]
+            },
+        }
+
+    @app.get("/reader/{url:path}")
+    async def reader(url: str):
+        app.state.requests += 1
+        await asyncio.sleep(latency)
+        error = _upstream_error(error_rate)
+        if error is not None:
+            return error
+        line = f"Content of {url}: unscrew the panel, then lift it carefully.\n"
+        return PlainTextResponse((line * (page_chars // len(line) + 1))[:page_chars])
+
+    return app
+
+
+class BackgroundServer:
+    """Run an ASGI app with uvicorn on a background thread."""
+
+    def __init__(self, app, host: str = "127.0.0.1", port: int = 0):
+        self.app = app
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
@@ -0,0 +1,105 @@
+"""Import time of the API module and time to the first response of a fresh server.
+
+Each measurement runs in a new interpreter, so nothing is cached between runs. The
+slowest imports are taken from `python -X importtime`. Run from the backend directory:
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.load import BACKEND_DIR, free_port
+
+
+def import_seconds(module: str) -> float:
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, stdout=subprocess.PIPE, check=True)
+    return float(result.stdout.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, top: int) -> list:
+    """Top-level packages with the largest cumulative import time, in milliseconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+    )
+    totals = {}
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith("import time:") or "|" not in line[13:]:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Direct imports of the measured module are indented by exactly two spaces
+        if name.startswith("  ") and not name.startswith("   ") and cumulative.strip().isdigit():
+            totals[name.strip()] = int(cumulative) / 1000
+    return sorted(({"module": k, "ms": round(v, 1)} for k, v in totals.items()), key=lambda x: -x["ms"])[:top]
+
+
+def first_response_seconds(command: list, env: dict, port: int, timeout: float = 120) -> float:
+    """Seconds from starting a server process to its first successful response."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"The server exited with code {process.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.02)
+        raise RuntimeError("The server did not answer in time")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def summary(values: list) -> dict:
+    return {"median": round(statistics.median(values), 3), "min": round(min(values), 3), "max": round(max(values), 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to report")
+    parser.add_argument("--gunicorn", action="store_true", help="Also time the preforked production launch")
+    args = parser.parse_args()
+
+    report = {
+        "import_api_seconds": summary([import_seconds("api") for _ in range(args.runs)]),
+        "slowest_imports": slowest_imports("api", args.top),
+        "first_response_seconds": {},
+    }
+
+    servers = {"uvicorn": lambda port: [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port)]}
+    if args.gunicorn:
+        servers["gunicorn"] = lambda port: [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "api:app",
+        ]
+    for name, command in servers.items():
+        for warm_up in ("false", "true"):
+            env = {
+                **os.environ,
+                "WARM_UP": warm_up,
+                "SPEECH_BACKEND": os.getenv("SPEECH_BACKEND", "stub"),
+                # The client is created at startup, no call is made
+                "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "startup-benchmark"),
+            }
+            times = []
+            for _ in range(args.runs):
+                port = free_port()
+                times.append(first_response_seconds(command(port), env, port))
+            report["first_response_seconds"][f"{name}{'_warm_up' if warm_up == 'true' else ''}"] = summary(times)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Compare the vision request payload and latency with and without upload preprocessing.
+
+Uses the images in test_images/ plus synthetic phone-sized photos, and sends the
+request to a local stand-in OpenAI server. Run from the backend directory:
+
+    python -m benchmarks.upload_payload --photos 10
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import time
+
+from PIL import Image
+
+from benchmarks.standins import BackgroundServer, make_openai_app
+from llm import create_openai_client
+from preprocess import (
+    create_image_pool,
+    image_content_parts,
+    parse_detail,
+    prepare_vision_images,
+)
+from schemas import Instructions
+
+TEST_IMAGES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "test_images")
+
+
+def synthetic_photo(seed: int, size=(4032, 3024)) -> bytes:
+    """A noisy 12 MP JPEG, roughly the size of a phone photo."""
+    noise = Image.effect_noise(size, 40 + seed % 20).convert("RGB")
+    gradient = Image.linear_gradient("L").resize(size).convert("RGB")
+    buffer = io.BytesIO()
+    Image.blend(noise, gradient, 0.5).save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue()
+
+
+def load_images(n_photos: int):
+    images = []
+    for filename in sorted(os.listdir(TEST_IMAGES_DIR)):
+        with open(os.path.join(TEST_IMAGES_DIR, filename), "rb") as f:
+            images.append(f.read())
+    images += [synthetic_photo(seed) for seed in range(n_photos)]
+    return images
+
+
+async def send(client, parts):
+    start = time.perf_counter()
+    await client.beta.chat.completions.parse(
+        model="gpt-4o",
+        messages=[{"role": "user", "content": [{"type": "text", "text": "Describe each image."}, *parts]}],
+        response_format=Instructions,
+    )
+    return time.perf_counter() - start
+
+
+async def run(base_url: str, images, rounds: int):
+    client = create_openai_client(base_url=f"{base_url}/v1", api_key="stand-in")
+    executor = create_image_pool()
+    try:
+        raw_parts = [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}"}}
+            for data in images
+        ]
+        raw_latency = min([await send(client, raw_parts) for _ in range(rounds)])
+
+        start = time.perf_counter()
+        vision_images = await prepare_vision_images(executor, images, parse_detail(None, len(images)))
+        preprocess_time = time.perf_counter() - start
+        parts = image_content_parts(vision_images)
+        latency = min([await send(client, parts) for _ in range(rounds)])
+
+        return {
+            "images": len(images),
+            "raw_payload_bytes": len(json.dumps(raw_parts)),
+            "preprocessed_payload_bytes": len(json.dumps(parts)),
+            "preprocess_seconds": round(preprocess_time, 3),
+            "raw_request_seconds": round(raw_latency, 3),
+            "preprocessed_request_seconds": round(latency, 3),
+        }
+    finally:
+        executor.shutdown()
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--photos", type=int, default=10, help="number of synthetic 12 MP photos to add")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    images = load_images(args.photos)
+    with BackgroundServer(make_openai_app()) as server:
+        result = asyncio.run(run(server.url, images, args.rounds))
+    result["payload_reduction"] = round(1 - result["preprocessed_payload_bytes"] / result["raw_payload_bytes"], 3)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Peak memory and CPU time of parsing large video requests and serialising large responses.
+
+Compares the default JSON handling (json.loads + pydantic validation, base64 decoding,
+json.dumps) with model_validate_json, binary multipart parts and orjson. Run from the
+backend directory:
+
+    python -m benchmarks.video_request_body --images 40 --image-kb 2048
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+import orjson
+
+from helpers import decode_base64_image
+from schemas import VideoRequest
+
+
+def measure(fn):
+    tracemalloc.start()
+    start = time.process_time()
+    fn()
+    cpu = time.process_time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"cpu_seconds": round(cpu, 4), "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--image-kb", type=int, default=2048)
+    args = parser.parse_args()
+
+    raw_images = [os.urandom(args.image_kb * 1024) for _ in range(args.images)]
+    descriptions = [f"Step {idx}: fold along the crease." for idx in range(args.images)]
+    data_urls = [f"data:image/png;base64,{base64.b64encode(data).decode('ascii')}" for data in raw_images]
+    body = json.dumps({"images": data_urls, "descriptions": descriptions}).encode("utf-8")
+    pages = [{"description": d, "image": url} for d, url in zip(descriptions, data_urls)]
+
+    def default_request():
+        request = VideoRequest(**json.loads(body))
+        [decode_base64_image(image) for image in request.images]
+
+    def validate_json_request():
+        request = VideoRequest.model_validate_json(body)
+        [decode_base64_image(image) for image in request.images]
+
+    def multipart_request():
+        # Binary parts arrive as bytes, only the small fields are validated
+        VideoRequest(images=[], descriptions=descriptions)
+        [bytes(data) for data in raw_images]
+
+    results = {
+        "request_body_bytes": len(body),
+        "request_json_default": measure(default_request),
+        "request_json_validate_json": measure(validate_json_request),
+        "request_multipart": measure(multipart_request),
+        "response_json_dumps": measure(lambda: json.dumps(pages).encode("utf-8")),
+        "response_orjson": measure(lambda: orjson.dumps(pages)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
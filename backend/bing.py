@@ -1,22 +1,84 @@
 
-import json
+import asyncio
 import os
+import time
+from collections import OrderedDict
 from typing import Dict, List, Optional
 
-import requests
+import httpx
 from dotenv import load_dotenv
 
+from metrics import upstream_event_hooks
+from upstream import get_limiter
+
 load_dotenv()
 
+BING_ENDPOINT = os.getenv("BING_ENDPOINT", "https://api.bing.microsoft.com/v7.0/search")
+JINA_READER_URL = os.getenv("JINA_READER_URL", "https://r.jina.ai/")
+# Number of result pages read concurrently for the search context
+BING_FETCH_PAGES = int(os.getenv("BING_FETCH_PAGES", "3"))
+JINA_FETCH_TIMEOUT = float(os.getenv("JINA_FETCH_TIMEOUT", "10"))
+WEB_CACHE_TTL = float(os.getenv("WEB_CACHE_TTL", "3600"))
+WEB_CACHE_MAX_ENTRIES = int(os.getenv("WEB_CACHE_MAX_ENTRIES", "1024"))
+# cap at 2k char (500 tokens, for OpenAI limit risk)
+CONTEXT_CHAR_LIMIT = 2000
+
+
+class TTLCache:
+    """Small in-memory LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, ttl: float = WEB_CACHE_TTL, max_entries: int = WEB_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+search_cache = TTLCache()
+reader_cache = TTLCache()
+
+
+def create_web_client() -> httpx.AsyncClient:
+    """Pooled, keep-alive HTTP client shared by the Bing and Jina Reader calls."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30),
+        timeout=httpx.Timeout(JINA_FETCH_TIMEOUT, connect=5),
+        follow_redirects=True,
+        event_hooks=upstream_event_hooks(),
+    )
+
+
 class BingSearchAPI:
-    def __init__(self, subscription_key: str, endpoint: str = "https://api.bing.microsoft.com/v7.0/search"):
+    def __init__(self, client: httpx.AsyncClient, subscription_key: str, endpoint: str = BING_ENDPOINT):
         """
         Initialize the Bing Search API client.
-        
+
         Args:
+            client: Shared async HTTP client
             subscription_key: Your Bing API subscription key
             endpoint: Bing Search API endpoint (defaults to v7.0)
         """
+        self.client = client
         self.subscription_key = subscription_key
         self.endpoint = endpoint
         self.headers = {
@@ -24,104 +86,148 @@ class BingSearchAPI:
             "Accept": "application/json"
         }
 
-    def search(self, query: str, count: int = 5) -> List[Dict]:
+    async def search(self, query: str, count: int = 5) -> List[Dict]:
         """
         Perform a Bing web search and return top results.
-        
+
         Args:
             query: Search query string
             count: Number of results to return (default 5)
-            
+
         Returns:
             List of dictionaries containing search results
         """
-        
+        cached = search_cache.get((self.endpoint, query, count))
+        if cached is not None:
+            return cached
+
         # Add site exclusion operators to query
         modified_query = query + " " + " ".join(f"-site:{site}" for site in ["youtube.com", "youtu.be"])
-        
+
         params = {
             "q": modified_query,
             "count": count * 2,  # Request more results since we'll be filtering some out
             "textDecorations": True,
             "textFormat": "HTML"
         }
-        
-        try:
-            response = requests.get(self.endpoint, headers=self.headers, params=params)
+
+        async def fetch() -> httpx.Response:
+            response = await self.client.get(self.endpoint, headers=self.headers, params=params)
             response.raise_for_status()
-            
+            return response
+
+        try:
+            # Concurrent identical searches share one request
+            response = await get_limiter("bing").run(fetch, "search", key=(self.endpoint, query, count))
+
             search_results = response.json()
-            
+
+            results = []
             if "webPages" in search_results and "value" in search_results["webPages"]:
-                results = []
                 for item in search_results["webPages"]["value"][:count]:
                     results.append({
                         "title": item["name"],
                         "url": item["url"],
                         "snippet": item["snippet"]
                     })
-                return results
-            return []
-            
-        except requests.exceptions.RequestException as e:
+            search_cache.put((self.endpoint, query, count), results)
+            return results
+
+        except httpx.HTTPError as e:
             print(f"Error during API request: {e}")
             return []
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             print(f"Error parsing API response: {e}")
             return []
-        
-def bing_search(query):
 
+
+async def bing_search(client: httpx.AsyncClient, query: str, pages: int = BING_FETCH_PAGES) -> str:
+    """Search the web and build a short context from the top result pages.
+
+    The top `pages` results are read concurrently, so the latency is the slowest
+    fetch rather than the sum of them. Each page gets an equal share of the
+    character budget.
+    """
     subscription_key = os.getenv("BING_API_KEY")
-    
+
     # Initialize the API client
-    bing_search = BingSearchAPI(subscription_key)
+    bing_search = BingSearchAPI(client, subscription_key)
 
     # perform search
-    results = bing_search.search(query,1)
+    results = await bing_search.search(query, pages)
+    if not results:
+        return ""
 
     print(f"Bing search result: {results[0]['snippet']}")
     print(f"URL: {results[0]['url']}")
 
-    parsed_result = parse_with_jina_reader(results[0]['url'])
-    
-    end_result= results[0]["snippet"] + "\n" + parsed_result
+    budget = CONTEXT_CHAR_LIMIT // len(results)
+    parsed_results = await asyncio.gather(
+        *(parse_with_jina_reader(client, result["url"], max_chars=budget) for result in results)
+    )
+
+    sections = []
+    for result, parsed_result in zip(results, parsed_results):
+        section = result["snippet"] + "\n" + (parsed_result or "")
+        sections.append(section[:budget])
+    end_result = "\n\n".join(sections)
 
     print("Before truncation: ", len(end_result))
 
     # cap at 2k char (500 tokens, for OpenAI limit risk)
-    end_result = end_result[:2000]
+    end_result = end_result[:CONTEXT_CHAR_LIMIT]
 
     print("After truncation: ", len(end_result))
     return end_result
 
-def parse_with_jina_reader(url: str) -> Optional[str]:
 
+async def parse_with_jina_reader(
+    client: httpx.AsyncClient,
+    url: str,
+    max_chars: int = CONTEXT_CHAR_LIMIT,
+    timeout: float = JINA_FETCH_TIMEOUT,
+) -> Optional[str]:
     """
     Fetches content from a URL using the Jina Reader service.
-    
+
+    The response is streamed and the connection closed as soon as `max_chars`
+    characters have arrived.
+
     Args:
+        client (httpx.AsyncClient): Shared async HTTP client
         url (str): The URL to fetch content from
-        
+        max_chars (int): Number of characters to keep
+        timeout (float): Time limit for the whole fetch, in seconds
+
     Returns:
         Optional[str]: The content of the response if successful, None if failed
-        
-    Raises:
-        requests.RequestException: If there's an error making the request
     """
-    try:
+    cached = reader_cache.get((url, max_chars))
+    if cached is not None:
+        return cached
+
+    async def fetch() -> str:
         # Construct the full URL
-        full_url = f"https://r.jina.ai/{url}"
-        
-        # Make the request
-        response = requests.get(full_url)
-        
-        # Raise an exception for bad status codes
-        response.raise_for_status()
-        
-        # Return the content
-        return response.text
-        
-    except requests.RequestException as e:
-        print(f"Error fetching URL: {e}")
+        full_url = f"{JINA_READER_URL}{url}"
+        chunks = []
+        received = 0
+        async with client.stream("GET", full_url) as response:
+            # Raise an exception for bad status codes
+            response.raise_for_status()
+            async for chunk in response.aiter_text():
+                chunks.append(chunk)
+                received += len(chunk)
+                if received >= max_chars:
+                    # Leaving the block closes the connection, the rest is never downloaded
+                    break
+        return "".join(chunks)[:max_chars]
+
+    try:
+        # The timeout bounds the whole read, retries included
+        content = await asyncio.wait_for(get_limiter("jina").run(fetch, "read", key=(url, max_chars)), timeout)
+    except (httpx.HTTPError, asyncio.TimeoutError) as e:
+        print(f"Error fetching URL: {e!r}")
         return None
+
+    reader_cache.put((url, max_chars), content)
+    return content
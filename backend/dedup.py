@@ -0,0 +1,81 @@
+import asyncio
+import io
+import os
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, List, NamedTuple
+
+from PIL import Image, ImageOps
+
+if TYPE_CHECKING:
+    import numpy as np
+
+DEDUP_HASH_SIZE = 8  # 8x8 difference hash, 64 bits
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+
+
+class DedupResult(NamedTuple):
+    representatives: List[int]  # index of the upload kept for each group, in order
+    groups: List[List[int]]  # indices of the uploads merged into each kept upload
+
+
+def grayscale_thumbnail(data: bytes, hash_size: int = DEDUP_HASH_SIZE) -> "np.ndarray":
+    """Decode an image into a tiny (hash_size, hash_size + 1) grayscale array."""
+    # NumPy is only loaded once deduplication is used
+    import numpy as np
+
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (hash_size * 8, hash_size * 8))
+    image = ImageOps.exif_transpose(image).convert("L")
+    return np.asarray(image.resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+
+
+def difference_hashes(thumbnails: "np.ndarray") -> "np.ndarray":
+    """Difference hashes of a stack of thumbnails, as packed bits of shape (N, hash_size ** 2 / 8)."""
+    import numpy as np
+
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return np.packbits(bits.reshape(len(thumbnails), -1), axis=1)
+
+
+def hamming_distances(hashes: "np.ndarray") -> "np.ndarray":
+    """Pairwise Hamming distances between packed hashes, shape (N, N)."""
+    import numpy as np
+
+    xor = np.bitwise_xor(hashes[:, None, :], hashes[None, :, :])
+    return np.unpackbits(xor, axis=2).sum(axis=2)
+
+
+def group_near_duplicates(hashes: "np.ndarray", max_distance: int = DEDUP_MAX_DISTANCE) -> DedupResult:
+    """Group consecutive near-duplicate images.
+
+    Uploads are a temporal sequence, so only runs of adjacent images are merged: an image
+    joins the current group when it is within max_distance bits of the group's first image.
+    Similar looking steps further apart stay separate pages.
+    """
+    distances = hamming_distances(hashes)
+    groups = []
+    for idx in range(len(hashes)):
+        if groups and distances[groups[-1][0], idx] <= max_distance:
+            groups[-1].append(idx)
+        else:
+            groups.append([idx])
+    return DedupResult([group[0] for group in groups], groups)
+
+
+async def find_near_duplicates(
+    executor: Executor,
+    images: List[bytes],
+    max_distance: int = DEDUP_MAX_DISTANCE,
+    hash_size: int = DEDUP_HASH_SIZE,
+) -> DedupResult:
+    """Decode thumbnails across the pool, then hash and group them in one vectorized pass."""
+    import numpy as np
+
+    if not images:
+        return DedupResult([], [])
+    loop = asyncio.get_running_loop()
+    thumbnails = await asyncio.gather(
+        *(loop.run_in_executor(executor, grayscale_thumbnail, data, hash_size) for data in images)
+    )
+    hashes = difference_hashes(np.stack(thumbnails))
+    return group_near_duplicates(hashes, max_distance)
@@ -0,0 +1,219 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from metrics import DISK_CACHE_EVICTIONS, DISK_CACHE_LOOKUPS, counter_totals
+
+# A recount evicts down to this share of max_bytes, so a full cache is not recounted on every put
+EVICTION_LOW_WATERMARK = 0.9
+
+
+def atomic_write(path: str, data: bytes):
+    """Write to a temp file in the same directory, then rename it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DiskCache:
+    """Disk-backed, size-capped LRU cache of byte blobs with an optional TTL.
+
+    Each entry is a data file plus a small JSON sidecar holding its metadata. Entries
+    are written atomically (data first, then the sidecar), so several processes can
+    share one cache directory. Each process tracks the bytes it knows of, and once that
+    goes over max_bytes it recounts the directory under a lock file and evicts from it,
+    so max_bytes bounds the directory as a whole. Between recounts the directory may
+    exceed it by what the other processes wrote meanwhile.
+
+    Hits, misses and evictions are Prometheus counters labelled with the cache `name`, so
+    the stats cover every process using the cache (with PROMETHEUS_MULTIPROC_DIR set).
+    """
+
+    name = "disk"
+
+    def __init__(self, directory: str, max_bytes: int, ttl: Optional[float] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    @contextmanager
+    def _directory_lock(self):
+        """Hold an exclusive lock on the cache directory, shared with other processes."""
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        """Build the index from the sidecars on disk, least recently used first."""
+        metas = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json"):
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.directory, filename))
+                except OSError:
+                    continue  # Removed by another process meanwhile
+                metas.append((mtime, filename[: -len(".json")]))
+        for _, key in sorted(metas):
+            meta = self._read_meta(key)
+            if meta is not None:
+                self.entries[key] = meta["size"]
+                self.total_bytes += meta["size"]
+
+    def _read_meta(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._meta_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expired(self, meta: dict) -> bool:
+        return self.ttl is not None and time.time() - meta.get("created_at", 0) > self.ttl
+
+    def _remove(self, key: str) -> int:
+        """Delete an entry, returning the size of its data."""
+        meta = self._read_meta(key)
+        paths = [self._meta_path(key)]
+        if meta is not None:
+            paths.append(os.path.join(self.directory, meta["file"]))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        size = self.entries.pop(key, 0)
+        self.total_bytes -= size
+        return meta["size"] if meta is not None else size
+
+    def _touch(self, key: str):
+        """Mark an entry as recently used, for every process sharing the directory."""
+        try:
+            os.utime(self._meta_path(key))
+        except FileNotFoundError:
+            pass  # evicted by another process since it was read
+
+    def _count(self, result: str):
+        DISK_CACHE_LOOKUPS.labels(self.name, result).inc()
+
+    def _scan(self) -> Tuple[int, List[Tuple[float, str]]]:
+        """Bytes of data in the directory and (last use, key) of its entries, least recently used first.
+
+        Only file sizes and modification times are read (os.scandir), no sidecar is parsed.
+        """
+        total = 0
+        sidecars = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue  # lock file and temp files being written
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # removed by another process meanwhile
+                if entry.name.endswith(".json"):
+                    sidecars.append((stat.st_mtime, entry.name[: -len(".json")]))
+                else:
+                    total += stat.st_size
+        sidecars.sort()
+        return total, sidecars
+
+    def _evict_shared(self):
+        """Recount the directory, entries of every process included, and evict least recently used ones.
+
+        A sidecar is parsed for the entries evicted only.
+        """
+        with self._directory_lock():
+            total, sidecars = self._scan()
+            target = self.max_bytes * EVICTION_LOW_WATERMARK if total > self.max_bytes else self.max_bytes
+            for _, key in sidecars:
+                if total <= target:
+                    break
+                total -= self._remove(key)
+                DISK_CACHE_EVICTIONS.labels(self.name).inc()
+            self.total_bytes = total
+
+    def get(self, key: str) -> Optional[Tuple[bytes, dict]]:
+        """Return (data, metadata) for a key, or None on a miss."""
+        with self.lock:
+            meta = self._read_meta(key)
+            data = None
+            if meta is not None and not self._expired(meta):
+                try:
+                    with open(os.path.join(self.directory, meta["file"]), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    data = None
+
+            if data is None:
+                self._count("miss")
+                if meta is not None or key in self.entries:
+                    self._remove(key)
+                return None
+
+            self._count("hit")
+            if key not in self.entries:
+                # Written by another process sharing the cache directory
+                self.entries[key] = meta["size"]
+                self.total_bytes += meta["size"]
+            self.entries.move_to_end(key)
+            self._touch(key)
+            return data, meta
+
+    def put(self, key: str, data: bytes, meta: Optional[dict] = None, suffix: str = ".bin"):
+        """Store data under a key with extra metadata, evicting least recently used entries."""
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        filename = f"{key}{suffix}"
+        meta = {**(meta or {}), "file": filename, "size": size, "created_at": time.time()}
+        with self.lock:
+            self._remove(key)
+            atomic_write(os.path.join(self.directory, filename), data)
+            atomic_write(self._meta_path(key), json.dumps(meta).encode("utf-8"))
+            self.entries[key] = size
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                # Other processes add and evict entries too, evict from what is on disk now
+                self._evict_shared()
+
+    def stats(self) -> dict:
+        """Lookups and evictions of every process, and the current content of the directory.
+
+        Reads the metric files and lists the directory, call it from a thread.
+        """
+        lookups = counter_totals("disk_cache_lookups", "result", cache=self.name)
+        evictions = counter_totals("disk_cache_evictions", "cache", cache=self.name)
+        hits, misses = lookups.get("hit", 0.0), lookups.get("miss", 0.0)
+        total, sidecars = self._scan()
+        return {
+            "hits": int(hits),
+            "misses": int(misses),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "evictions": int(evictions.get(self.name, 0.0)),
+            "entries": len(sidecars),
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+        }
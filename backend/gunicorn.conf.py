@@ -0,0 +1,34 @@
+"""Production server settings, used with: gunicorn -c gunicorn.conf.py api:app"""
+import os
+import shutil
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Also read by the app (loaded after this file) to size its process pools per worker
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# The app is imported once in the master, workers are forked with its modules already loaded
+preload_app = True
+# Video renders keep a request open for minutes
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+graceful_timeout = 30
+keepalive = 5
+
+# Each worker has its own metrics, /metrics aggregates them through this directory
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+
+def on_starting(server):
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+    from warmup import WARM_UP, warm_up
+
+    if WARM_UP:
+        warm_up()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,18 +1,25 @@
+import asyncio
 import base64
 import io
 import os
-import re
 import shutil
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 
-import azure.cognitiveservices.speech as speechsdk
-import cv2
-from openai import OpenAI
+from openai import AsyncOpenAI
 from PIL import Image
-from pydub import AudioSegment
 
-from schemas import CleanedText
+from audio_cache import audio_cache_key, get_audio_cache
+from markdown_scan import iter_image_refs, markdown_text
+from schemas import CleanedText, CleanedTexts
+from segments import (
+    SEGMENT_RENDER_CONCURRENCY,
+    get_segment_cache,
+    segment_cache_key,
+    workspace_segment_path,
+)
+from tts import TTS_CONCURRENCY, get_speech_backend, speech_voice_id, synthesize_many
+from upstream import estimate_tokens, get_limiter, request_key
 
 
 # Function to encode image as base64 and resize to fit within max_sizexmax_size
@@ -20,7 +27,7 @@ def encode_image_resized(file, max_size=(750, 750), colors=64):
     # Open the image and convert to RGB (or use original mode if necessary)
     image = Image.open(file).convert("RGB")
     # Resize the image to fit within max_size, preserving aspect ratio
-    image.thumbnail(max_size, Image.ANTIALIAS)
+    image.thumbnail(max_size, Image.LANCZOS)
     # Optionally reduce colors to save on data size
     image = image.convert("P", palette=Image.ADAPTIVE, colors=colors)
     # Save to a bytes buffer and encode as base64
@@ -44,22 +51,18 @@ def process_files_with_descriptions(images_b64: List[str], instructions: List[st
     
     return result
 
+# Decode a base64 image, with or without data URL prefix
+def decode_base64_image(base64_str: str) -> bytes:
+    if ',' in base64_str:
+        base64_str = base64_str.split(',')[1]
+    return base64.b64decode(base64_str)
+
+
 # Extract b64 images from string
 def extract_images_from_markdown(content):
     """Extract base64 images from markdown content."""
-    # Pattern to match full markdown image syntax with base64 data
-    image_pattern = r'!\[(.*?)\]\((data:image\/[^;]+;base64,[^)]+)\)'
-    matches = re.findall(image_pattern, content)
-    
-    if not matches:
-        return []
-        
-    # Get the full markdown image syntax
-    full_matches = []
-    for match in re.finditer(image_pattern, content):
-        full_matches.append(match.group(0))  # This gets the entire match
-    
-    return full_matches
+    # Single pass over the document, see markdown_scan for the equivalent pattern
+    return [content[ref.start:ref.end] for ref in iter_image_refs(content)]
 
 # Some prompt engineering for content improvement requested by the user in the frontend
 def create_chat_messages(content, improve_text, base64_images):
@@ -99,128 +102,6 @@ Provide only the improved markdown content without any explanations or meta-comm
 
 ### VIDEO GENERATION
 
-def create_video_from_images(images, durations, output_video_path):
-    """Create a video from a list of images with corresponding display durations.
-
-    Args:
-        images (list of str): List of file paths to images.
-        durations (list of float): List of durations (in seconds) for each image.
-        output_video_path (str): The file path where the output video will be saved.
-    
-    Returns:
-        None
-    """
-    # Check if the lengths of the images and durations lists are the same
-    if len(images) != len(durations):
-        print("Error: The number of images must match the number of durations.")
-        return
-
-    # Read the first image to get dimensions
-    first_image_path = images[0]
-    frame = cv2.imread(first_image_path)
-    if frame is None:
-        print(f"Error: Unable to read image {first_image_path}.")
-        return
-
-    height, width, layers = frame.shape
-
-    # Create a VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Codec for .mp4
-    video = cv2.VideoWriter(output_video_path, fourcc, 30.0, (width, height))
-
-    # Loop through images and durations to create the video
-    for img_path, duration in zip(images, durations):
-        frame = cv2.imread(img_path)
-        if frame is None:
-            print(f"Error: Unable to read image {img_path}. Skipping.")
-            continue
-
-        # Calculate the number of frames for the given duration
-        frame_count = int(duration * 30)  # Assuming 30 FPS
-
-        # Write the same frame multiple times based on duration
-        for _ in range(frame_count):
-            video.write(frame)
-
-    # Release the VideoWriter object
-    video.release()
-    print(f"Video saved at {output_video_path}")
-
-def merge_mp3s(mp3_files, output_path):
-    """Merge multiple MP3 files into a single MP3 file.
-
-    Args:
-        mp3_files (list of str): List of file paths to the MP3 files to be merged.
-        output_path (str): The file path where the merged MP3 will be saved.
-
-    Returns:
-        None
-    """
-    # Start with an empty AudioSegment
-    combined = AudioSegment.empty()
-
-    # Loop through each file, read it, and append to combined
-    for mp3_file in mp3_files:
-        try:
-            audio = AudioSegment.from_file(mp3_file)
-            combined += audio  # Concatenate the audio segments
-        except Exception as e:
-            print(f"Error reading {mp3_file}: {e}")
-
-    # Export the combined audio to a single MP3 file
-    combined.export(output_path, format='mp3')
-    
-    # Delete the small mp3 files
-    for mp3_file in mp3_files:
-        os.remove(mp3_file)
-        
-    print(f"Merged audio saved at {output_path}")
-
-def combine_video_and_audio(video_path, audio_path, output_path):
-    """Combine a video file with an audio file, creating a new video file with audio.
-
-    Args:
-        video_path (str): The file path of the video to be combined.
-        audio_path (str): The file path of the audio to be combined with the video.
-        output_path (str): The file path where the output video with audio will be saved.
-
-    Returns:
-        None
-    """
-    # Load the video to get its duration
-    video = cv2.VideoCapture(video_path)
-    fps = video.get(cv2.CAP_PROP_FPS)
-    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    video_duration = frame_count / fps
-    video.release()
-
-    # Load the audio to get its duration
-    audio = AudioSegment.from_file(audio_path)
-    audio_duration = len(audio) / 1000  # Convert ms to seconds
-
-    # Calculate the minimum duration
-    min_duration = min(video_duration, audio_duration)
-
-    # Trim audio to the minimum duration
-    trimmed_audio = audio[:int(min_duration * 1000)]  # Convert seconds to ms
-    trimmed_audio.export("trimmed_audio.mp3", format='mp3')
-
-    # Use ffmpeg to combine video and the trimmed audio
-    command = [
-        'ffmpeg', '-y','-i', video_path, '-i', 'trimmed_audio.mp3', 
-        '-c:v', 'copy', '-c:a', 'aac', '-strict', 'experimental', 
-        '-shortest', output_path
-    ]
-
-    # Run the command
-    subprocess.run(command)
-
-    # Clean up temporary audio file
-    os.remove("trimmed_audio.mp3")
-    os.remove(video_path)
-    os.remove(audio_path)
-    print(f"Combined video saved at {output_path}")
-
 def get_files(directory, extension):
     """Retrieve all files with a specific extension from a directory.
 
@@ -247,111 +128,138 @@ def generate_audio_clips(
     descriptions: List[str], 
     basepath: str, 
     language: str = "en-US",
+    concurrency: int = TTS_CONCURRENCY,
 ) -> List[Tuple[str, int]]:
     """
     Generate audio clips using Azure Speech Services.
 
+    Clips are synthesized concurrently into memory by a pool of reusable synthesizers,
+    and their durations come from the synthesis result instead of decoding the audio.
+    Previously synthesized texts are served from the audio cache.
+
     Args:
         descriptions (list of str): List of text descriptions to convert to audio
         basepath (str): The base path where audio files will be saved
-        speech_key (str): Azure Speech Services API key
-        speech_region (str): Azure Speech Services region
         language (str): Language code for speech synthesis (default "en-US")
-        voice_name (str): Name of the voice to use (default "en-US-JennyNeural")
+        concurrency (int): Number of clips synthesized at the same time
 
     Returns:
         list of tuples: A list containing tuples of (audio_path, duration_ms)
     """
-    audio_info = []
-    
-    speech_key = os.getenv("SPEECH_KEY")
-    speech_region = "switzerlandnorth"
-    voice_name: str = "en-US-BrandonMultilingualNeural"
-
-    # Configure speech service
-    speech_config = speechsdk.SpeechConfig(
-        subscription=speech_key, 
-        region=speech_region
-    )
-    speech_config.speech_synthesis_voice_name = voice_name
-
-    for idx, text in enumerate(descriptions):
-        # Set up audio output configuration
-        audio_path = f"{basepath}audio_{idx}.mp3"
-        audio_config = speechsdk.AudioConfig(filename=audio_path)
-
-        # Create speech synthesizer
-        speech_synthesizer = speechsdk.SpeechSynthesizer(
-            speech_config=speech_config, 
-            audio_config=audio_config
-        )
-
-        # Generate speech and wait for completion
-        speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
-
-        if speech_synthesis_result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-            # Load the audio file to get its duration
-            audio = AudioSegment.from_file(audio_path)
-            duration = len(audio)  # Duration in milliseconds
-            audio_info.append((audio_path, duration))
+    backend = get_speech_backend(language)
+    cache = get_audio_cache()
+    keys = [
+        audio_cache_key(text, backend.voice_name, backend.language, backend.output_format_name)
+        for text in descriptions
+    ]
+
+    # Only synthesize texts that are neither cached nor repeated within this request
+    clips_by_key = {}
+    missing = {}
+    for key, text in zip(keys, descriptions):
+        if key in clips_by_key or key in missing:
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            clips_by_key[key] = cached
         else:
-            if speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-                cancellation_details = speech_synthesis_result.cancellation_details
-                print(f"Speech synthesis canceled: {cancellation_details.reason}")
-                if cancellation_details.reason == speechsdk.CancellationReason.Error:
-                    print(f"Error details: {cancellation_details.error_details}")
-            raise Exception("Speech synthesis failed")
+            missing[key] = text
+
+    for key, clip in zip(missing, synthesize_many(backend, list(missing.values()), width=concurrency)):
+        cache.put(key, clip)
+        clips_by_key[key] = clip
+    clips = [clips_by_key[key] for key in keys]
+
+    audio_info = []
+    for idx, clip in enumerate(clips):
+        audio_path = f"{basepath}audio_{idx}.{clip.format}"
+        with open(audio_path, "wb") as audio_file:
+            audio_file.write(clip.audio)
+        audio_info.append((audio_path, clip.duration_ms))
 
     return audio_info
 
-def generateteVideofromimagesandaudio(pngs, descriptions):
+def generateteVideofromimagesandaudio(images, descriptions, output_dir="./output", progress=None, segment_keys=None):
     """Generate a video from images and audio descriptions.
 
+    Every page is rendered as its own segment (the image with its narration) and stored
+    in the segment cache, so pages that were rendered before, e.g. all but the edited
+    one, are reused as-is. The segments are then joined without re-encoding.
+
     Args:
-        pngs (list of str): List of file paths to PNG images.
+        images (list of bytes): The encoded images, one per page.
         descriptions (list of str): List of descriptions for the images to be converted to audio.
+            May be None for pages whose segment is already in place in output_dir.
+        output_dir (str): Directory for the temporary files and the output video.
+        progress (callable, optional): Called with the name of each stage as it starts.
+        segment_keys (list of str, optional): Segment cache key of each page, derived from
+            the images and descriptions by default.
 
     Returns:
-        None
+        str: The path of the generated video.
     """
+    # The video stack (NumPy, ffmpeg helpers) is loaded on first use, not when the API starts
+    from video import concat_segments, output_frame_size, render_slideshow
+
+    progress = progress or (lambda stage: None)
+
     # Create output directory if it doesn't exist
-    output_dir = "./output"
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Create temp directory for audio files
+    # Create temp directory for audio files and segments
     temp_dir = os.path.join(output_dir, "temp")
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-        
+    segment_paths = [workspace_segment_path(output_dir, idx) for idx in range(len(images))]
+    os.makedirs(os.path.dirname(segment_paths[0]), exist_ok=True)
+
     try:
-        # Generate mp3s from each text description, and record the durations
-        audiopaths, durations = zip(*generate_audio_clips(
-            descriptions, 
-            basepath=os.path.join(temp_dir, "audio_"),  # Changed basepath
+        frame_size = output_frame_size(images[0])
+        if segment_keys is None:
+            voice = speech_voice_id("en-US")
+            segment_keys = [
+                segment_cache_key(image, description, voice, frame_size)
+                for image, description in zip(images, descriptions)
+            ]
+
+        # Pages already in place or cached are not rendered again, repeated pages only once
+        cache = get_segment_cache()
+        first_page = {}
+        missing = []
+        for idx, key in enumerate(segment_keys):
+            if key in first_page:
+                segment_paths[idx] = segment_paths[first_page[key]]
+                continue
+            first_page[key] = idx
+            if not os.path.exists(segment_paths[idx]) and cache.link(key, segment_paths[idx]) is None:
+                missing.append(idx)
+        print(f"Rendering {len(missing)} of {len(images)} pages")
+
+        # Generate audio clips for the pages to render, the clip durations drive the page timing
+        progress("audio")
+        clips = generate_audio_clips(
+            [descriptions[idx] for idx in missing],
+            basepath=os.path.join(temp_dir, "audio_"),
             language="en-US"
-        ))
-        audiopaths = list(audiopaths)
-        durations = list(durations)
+        ) if missing else []
 
-        # Combine the audios into a single audio file
-        total_audio_path = os.path.join(temp_dir, 'totalaudio.mp3')
-        merge_mp3s(audiopaths, total_audio_path)
+        # Encode each missing page with its narration into a segment
+        progress("encode")
 
-        # Convert durations from milliseconds to seconds
-        durations = [d / 1000 for d in durations]
-        
-        # Log durations and images being processed
-        print(durations)
-        print(pngs)
+        def render_segment(idx, clip):
+            # The synthesis result (or the audio cache) knows the clip duration, no need to probe it
+            clip_path, duration_ms = clip
+            duration = duration_ms / 1000
+            render_slideshow([images[idx]], [duration], clip_path, segment_paths[idx], frame_size)
+            cache.put_segment(segment_keys[idx], segment_paths[idx], duration)
+            os.remove(clip_path)
 
-        # Generate a single video from the images using the durations
-        video_path = os.path.join(temp_dir, 'totalvideo.mp4')
-        create_video_from_images(pngs, durations, video_path)
+        with ThreadPoolExecutor(max_workers=max(1, SEGMENT_RENDER_CONCURRENCY)) as executor:
+            list(executor.map(render_segment, missing, clips))
 
-        # Generate a single video with the combined audio and the generated video
+        # Join the segments at the stream level
+        progress("merge")
         output_path = os.path.join(output_dir, 'video_with_audio.mp4')
-        combine_video_and_audio(video_path, total_audio_path, output_path)
+        concat_segments(segment_paths, output_path)
         
         return output_path
         
@@ -361,26 +269,85 @@ def generateteVideofromimagesandaudio(pngs, descriptions):
             shutil.rmtree(temp_dir)
 
 
-def clean_descriptions(descriptions):
-    client = OpenAI(
+CLEAN_MODEL = "gpt-4o-mini"
+CLEAN_SYSTEM_PROMPT = "Convert the following processed text into natural, engaging speech while maintaining the key information."
+CLEAN_CONCURRENCY = int(os.getenv("CLEAN_CONCURRENCY", "8"))
+
+
+async def clean_description(client: AsyncOpenAI, description: str) -> str:
+    """Turn a single markdown description into narration text."""
+    # Embedded images are not narrated, keep their base64 payloads out of the prompt
+    description = markdown_text(description)
+    messages = [
+        {"role": "system", "content": CLEAN_SYSTEM_PROMPT},
+        {"role": "user", "content": description},
+    ]
+    response = await get_limiter("openai").run(
+        lambda: client.beta.chat.completions.parse(model=CLEAN_MODEL, messages=messages, response_format=CleanedText),
+        "clean",
+        CLEAN_MODEL,
+        tokens=estimate_tokens(messages, len(description) // 4),
+        key=request_key(CLEAN_MODEL, messages),
     )
-    new_descriptions = []
-    for i in descriptions:
-        # Call OpenAI API
-        response = client.beta.chat.completions.parse(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": "Convert the following processed text into natural, engaging speech while maintaining the key information."
-            },
-            {
-                "role": "user",
-                "content": i
-            }],
-        
-        response_format=CleanedText)
-        json_str = response.choices[0].message.parsed
-        new_descriptions.append(json_str.cleaned_text)
-    return new_descriptions
-        
+    json_str = response.choices[0].message.parsed
+    return json_str.cleaned_text
+
+
+async def clean_descriptions_batch(client: AsyncOpenAI, descriptions: List[str]) -> List[str]:
+    """Clean all descriptions with a single structured-output call.
+
+    Falls back to per-description calls if the model does not return exactly one text per input.
+    """
+    numbered = "\n\n".join(f"### Text {idx + 1}\n{markdown_text(text)}" for idx, text in enumerate(descriptions))
+    messages = [
+        {
+            "role": "system",
+            "content": f"{CLEAN_SYSTEM_PROMPT} You receive {len(descriptions)} numbered texts. "
+            f"Return a list with exactly one converted text per input, in the same order.",
+        },
+        {"role": "user", "content": numbered},
+    ]
+    response = await get_limiter("openai").run(
+        lambda: client.beta.chat.completions.parse(model=CLEAN_MODEL, messages=messages, response_format=CleanedTexts),
+        "clean_batch",
+        CLEAN_MODEL,
+        tokens=estimate_tokens(messages, len(numbered) // 4),
+        key=request_key(CLEAN_MODEL, messages),
+    )
+    json_str = response.choices[0].message.parsed
+    if json_str is None or len(json_str.cleaned_texts) != len(descriptions):
+        print("Batch cleaning returned a mismatched list, falling back to per-description calls")
+        return await clean_descriptions(client, descriptions)
+    return json_str.cleaned_texts
+
+
+async def clean_descriptions(
+    client: AsyncOpenAI,
+    descriptions: List[str],
+    concurrency: int = CLEAN_CONCURRENCY,
+    batch: bool = False,
+) -> List[str]:
+    """Convert descriptions into narration text, concurrently.
+
+    Args:
+        client (AsyncOpenAI): The shared OpenAI client.
+        descriptions (list of str): Markdown descriptions, one per page.
+        concurrency (int): Maximum number of cleaning calls in flight at once.
+        batch (bool): Clean every description in one structured-output call instead.
+
+    Returns:
+        list of str: The cleaned descriptions, in the same order as the input.
+    """
+    if not descriptions:
+        return []
+    if batch:
+        return await clean_descriptions_batch(client, descriptions)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(description):
+        async with semaphore:
+            return await clean_description(client, description)
+
+    # gather keeps the results in input order
+    return list(await asyncio.gather(*(bounded(d) for d in descriptions)))
@@ -0,0 +1,402 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+from PIL import Image
+
+from helpers import (
+    CLEAN_MODEL,
+    CLEAN_SYSTEM_PROMPT,
+    clean_descriptions,
+    generateteVideofromimagesandaudio,
+)
+from metrics import (
+    STAGE_ERRORS,
+    STAGE_SECONDS,
+    VIDEO_JOBS_IN_FLIGHT,
+    init_pool_process,
+    stage_timer,
+)
+from segments import get_segment_cache, segment_cache_key, workspace_segment_path
+from tracing import add_span, span
+from tts import speech_voice_id
+
+# The web workers of a host (WEB_CONCURRENCY) split its CPUs, each runs its share of renders
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+VIDEO_WORKERS = int(os.getenv("VIDEO_WORKERS", str(max(1, (os.cpu_count() or 2) // 2 // WEB_CONCURRENCY))))
+VIDEO_MAX_PENDING_JOBS = int(os.getenv("VIDEO_MAX_PENDING_JOBS", "32"))
+VIDEO_JOBS_DIR = os.getenv("VIDEO_JOBS_DIR", "./output/jobs")
+VIDEO_JOB_TTL = float(os.getenv("VIDEO_JOB_TTL", "3600"))
+# The web worker owning a job refreshes its progress file this often while the job is pending.
+# A pending job whose owner stopped doing so for VIDEO_JOB_STALE_AFTER is reported as failed.
+VIDEO_JOB_HEARTBEAT = float(os.getenv("VIDEO_JOB_HEARTBEAT", "15"))
+VIDEO_JOB_STALE_AFTER = float(os.getenv("VIDEO_JOB_STALE_AFTER", "120"))
+HOSTNAME = socket.gethostname()
+
+# Stages reported by the status endpoint, in order
+STAGES = ["queued", "cleaning", "audio", "encode", "merge", "done"]
+JOB_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _write_json(path: str, data: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_progress(workspace: str, stage: str):
+    """Record the current stage of a job, readable from any process."""
+    _write_json(os.path.join(workspace, "progress.json"), {"stage": stage, "updated_at": time.time()})
+
+
+def read_progress(workspace: str) -> Optional[dict]:
+    return _read_json(os.path.join(workspace, "progress.json"))
+
+
+def touch_progress(workspace: str):
+    """Refresh the heartbeat of a job, the modification time of its progress file."""
+    try:
+        os.utime(os.path.join(workspace, "progress.json"))
+    except OSError:
+        pass  # the job was deleted meanwhile
+
+
+def last_heartbeat(workspace: str) -> Optional[float]:
+    try:
+        return os.path.getmtime(os.path.join(workspace, "progress.json"))
+    except OSError:
+        return None
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by another user
+    return True
+
+
+def write_job(job: dict):
+    """Record the status of a job in its workspace, so every web worker can serve it."""
+    _write_json(os.path.join(job["workspace"], "job.json"), job)
+
+
+def read_job(workspace: str) -> Optional[dict]:
+    return _read_json(os.path.join(workspace, "job.json"))
+
+
+def page_segment_keys(images: List[bytes], descriptions: List[str]) -> List[str]:
+    """Segment cache keys of the pages of a job, from their raw (uncleaned) descriptions."""
+    from video import output_frame_size
+
+    frame_size = output_frame_size(images[0])
+    voice = speech_voice_id("en-US")
+    narration = f"{CLEAN_MODEL}:{hashlib.sha256(CLEAN_SYSTEM_PROMPT.encode('utf-8')).hexdigest()}"
+    return [
+        segment_cache_key(image, description, voice, frame_size, narration)
+        for image, description in zip(images, descriptions)
+    ]
+
+
+def pin_cached_segments(workspace: str, keys: List[str]) -> List[bool]:
+    """Link the cached segments of a job into its workspace, so they survive eviction until the render."""
+    cache = get_segment_cache()
+    os.makedirs(os.path.dirname(workspace_segment_path(workspace, 0)), exist_ok=True)
+    return [cache.link(key, workspace_segment_path(workspace, idx)) is not None for idx, key in enumerate(keys)]
+
+
+def run_video_job(
+    workspace: str,
+    images: List[bytes],
+    descriptions: List[Optional[str]],
+    segment_keys: Optional[List[str]] = None,
+) -> Tuple[str, Dict[str, float]]:
+    """Render a video inside a job workspace. Runs in a worker process.
+
+    Args:
+        workspace (str): The job directory, all intermediate files stay inside it.
+        images (list of bytes): Uploaded images, in page order. They are decoded straight
+            into the encoder's frames, without intermediate image files.
+        descriptions (list of str): Cleaned narration text, one per image, None for pages
+            whose segment is already in the workspace.
+        segment_keys (list of str, optional): Segment cache key of each page.
+
+    Returns:
+        tuple: The path of the rendered video, and the duration of each stage in seconds.
+    """
+    # Stage durations are sent back with the result, the worker's own metrics are not scraped
+    stage_seconds = {}
+    current = [None, time.perf_counter()]
+
+    def progress(stage):
+        now = time.perf_counter()
+        if current[0] is not None:
+            stage_seconds[current[0]] = now - current[1]
+        current[:] = [stage, now]
+        write_progress(workspace, stage)
+
+    output_path = generateteVideofromimagesandaudio(
+        images=images,
+        descriptions=descriptions,
+        output_dir=workspace,
+        progress=progress,
+        segment_keys=segment_keys,
+    )
+    progress("done")
+    return output_path, stage_seconds
+
+
+class VideoJobManager:
+    """Runs video renders in a bounded process pool, one isolated workspace per job.
+
+    Job records live in the workspaces (job.json), not in memory, so any web worker
+    sharing VIDEO_JOBS_DIR can report, serve and delete a job submitted to another one.
+    Pending jobs whose owning worker died (timeout, deploy) are reported as failed once
+    the owner is gone or its heartbeat is stale, and pruned like any finished job.
+    """
+
+    def __init__(self, workers: int = VIDEO_WORKERS, jobs_dir: str = VIDEO_JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        # Jobs rendering in this process
+        self.tasks: Dict[str, asyncio.Task] = {}
+        # spawn keeps the workers free of the API process' event loop and threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_pool_process
+        )
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def workspace(self, job_id: str) -> Optional[str]:
+        """Workspace of a job, None for ids that cannot be a job (they end up in a path)."""
+        if not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        return os.path.join(self.jobs_dir, job_id)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """The record of a job, whichever worker runs it."""
+        workspace = self.workspace(job_id)
+        job = read_job(workspace) if workspace is not None else None
+        if job is not None and self.orphaned(job):
+            heartbeat = last_heartbeat(workspace) or job["created_at"]
+            job = {**job, "status": "failed", "finished_at": heartbeat, "error": "The worker running this job stopped."}
+        return job
+
+    def orphaned(self, job: dict) -> bool:
+        """Whether a queued or running job lost the web worker that owns it."""
+        if job["status"] not in ("queued", "running"):
+            return False
+        if job["job_id"] in self.tasks:
+            return False
+        if job.get("owner_host") == HOSTNAME and job.get("owner_pid") is not None:
+            # Includes jobs of an earlier process that had this pid, they are not in self.tasks
+            if job["owner_pid"] == os.getpid() or not pid_alive(job["owner_pid"]):
+                return True
+        heartbeat = last_heartbeat(job["workspace"]) or job["created_at"]
+        return time.time() - heartbeat > VIDEO_JOB_STALE_AFTER
+
+    def iter_jobs(self) -> Iterator[dict]:
+        try:
+            job_ids = os.listdir(self.jobs_dir)
+        except OSError:
+            return
+        for job_id in job_ids:
+            job = self.get(job_id)
+            if job is not None:
+                yield job
+
+    def pending_count(self) -> int:
+        return sum(1 for job in self.iter_jobs() if job["status"] in ("queued", "running"))
+
+    @staticmethod
+    def validate_images(images: List[bytes]):
+        """Check that the uploads are images before queueing the job."""
+        for idx, image_data in enumerate(images):
+            try:
+                # Only parses the header, decoding happens in the worker
+                Image.open(io.BytesIO(image_data))
+            except Exception as e:
+                raise ValueError(f"Invalid image at index {idx}: {str(e)}")
+
+    async def submit(
+        self,
+        client: AsyncOpenAI,
+        images: List[bytes],
+        descriptions: List[str],
+        batch_cleaning: bool = False,
+    ) -> str:
+        """Queue a render and return its job id.
+
+        Raises:
+            JobQueueFull: Too many jobs are already waiting or running.
+            ValueError: One of the images cannot be read.
+        """
+        # Both read every job record, and pruning deletes workspaces
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.prune)
+        if await loop.run_in_executor(None, self.pending_count) >= VIDEO_MAX_PENDING_JOBS:
+            raise JobQueueFull("Too many video jobs in progress, try again later.")
+        if len(images) != len(descriptions):
+            raise ValueError("The number of images must match the number of descriptions.")
+
+        self.validate_images(images)
+
+        job_id = uuid.uuid4().hex
+        workspace = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(workspace)
+        write_progress(workspace, "queued")
+        write_job({
+            "job_id": job_id,
+            "status": "queued",
+            "workspace": workspace,
+            "pages": len(images),
+            "created_at": time.time(),
+            "finished_at": None,
+            "owner_host": HOSTNAME,
+            "owner_pid": os.getpid(),
+            "result_path": None,
+            "reused_pages": 0,
+            "error": None,
+        })
+        self.tasks[job_id] = asyncio.create_task(
+            self._run(job_id, client, images, descriptions, batch_cleaning)
+        )
+        return job_id
+
+    @staticmethod
+    async def _heartbeat(workspace: str):
+        while True:
+            await asyncio.sleep(VIDEO_JOB_HEARTBEAT)
+            touch_progress(workspace)
+
+    async def _run(self, job_id, client, images, descriptions, batch_cleaning):
+        workspace = self.workspace(job_id)
+        job = read_job(workspace)
+        state = "preparing"
+        VIDEO_JOBS_IN_FLIGHT.labels(state).inc()
+        heartbeat = asyncio.create_task(self._heartbeat(workspace))
+        try:
+            job["status"] = "running"
+            write_job(job)
+            loop = asyncio.get_running_loop()
+            with stage_timer("segment_lookup"):
+                keys = await loop.run_in_executor(None, page_segment_keys, images, descriptions)
+                cached = await loop.run_in_executor(None, pin_cached_segments, workspace, keys)
+
+            # Only pages without a rendered segment need their narration cleaned
+            to_clean = {}
+            for key, description, is_cached in zip(keys, descriptions, cached):
+                if not is_cached and key not in to_clean:
+                    to_clean[key] = description
+            job["reused_pages"] = sum(cached)
+            write_job(job)
+
+            write_progress(workspace, "cleaning")
+            with stage_timer("cleaning"):
+                cleaned = await clean_descriptions(client, list(to_clean.values()), batch=batch_cleaning)
+            cleaned_by_key = dict(zip(to_clean, cleaned))
+            page_descriptions = [cleaned_by_key.get(key) for key in keys]
+
+            VIDEO_JOBS_IN_FLIGHT.labels(state).dec()
+            state = "rendering"
+            VIDEO_JOBS_IN_FLIGHT.labels(state).inc()
+            start = time.perf_counter()
+            with span("render", pages=len(images), reused_pages=job["reused_pages"]):
+                job["result_path"], stage_seconds = await loop.run_in_executor(
+                    self.executor, run_video_job, workspace, images, page_descriptions, keys
+                )
+                # The worker stages ran back to back and ended with the render
+                end = time.perf_counter()
+                for stage, seconds in reversed(list(stage_seconds.items())):
+                    add_span(stage, end - seconds, end)
+                    end -= seconds
+            for stage, seconds in stage_seconds.items():
+                STAGE_SECONDS.labels(stage).observe(seconds)
+            # Whatever the worker stages do not account for was spent waiting for a free worker
+            STAGE_SECONDS.labels("worker_wait").observe(max(0.0, time.perf_counter() - start - sum(stage_seconds.values())))
+            job["status"] = "done"
+        except Exception as e:
+            print(f"Video job {job_id} failed: {e}")
+            if state == "rendering":
+                STAGE_ERRORS.labels((read_progress(workspace) or {}).get("stage", "queued")).inc()
+            job["status"] = "failed"
+            job["error"] = str(e)
+        except asyncio.CancelledError:
+            # The worker is shutting down, the job will not complete
+            job["status"] = "failed"
+            job["error"] = "The worker running this job shut down."
+            raise
+        finally:
+            heartbeat.cancel()
+            VIDEO_JOBS_IN_FLIGHT.labels(state).dec()
+            job["finished_at"] = time.time()
+            try:
+                write_job(job)
+            except OSError:
+                pass  # the job was deleted meanwhile
+
+    def status(self, job_id: str) -> Optional[dict]:
+        job = self.get(job_id)
+        if job is None:
+            return None
+        progress = read_progress(job["workspace"]) or {}
+        stage = progress.get("stage", "queued")
+        return {
+            "job_id": job_id,
+            "status": job["status"],
+            "stage": stage,
+            "progress": STAGES.index(stage) / (len(STAGES) - 1) if stage in STAGES else 0.0,
+            "pages": job["pages"],
+            "reused_pages": job["reused_pages"],
+            "created_at": job["created_at"],
+            "finished_at": job["finished_at"],
+            "error": job["error"],
+        }
+
+    async def wait(self, job_id: str) -> dict:
+        """Wait for a job submitted by this process to finish and return its record."""
+        await asyncio.shield(self.tasks[job_id])
+        return self.get(job_id)
+
+    def remove(self, job_id: str):
+        """Forget a job and delete its workspace."""
+        self.tasks.pop(job_id, None)
+        workspace = self.workspace(job_id)
+        if workspace is not None:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    def prune(self):
+        """Remove finished jobs older than VIDEO_JOB_TTL, whichever worker ran them."""
+        now = time.time()
+        for job in list(self.iter_jobs()):
+            if job["finished_at"] is not None and now - job["finished_at"] > VIDEO_JOB_TTL:
+                self.remove(job["job_id"])
+
+    def shutdown(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
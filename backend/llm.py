@@ -0,0 +1,48 @@
+import os
+
+import httpx
+from fastapi import Request
+from openai import AsyncOpenAI
+
+from metrics import upstream_event_hooks
+
+# Connection pool sizing for the shared OpenAI client. One worker keeps many
+# upstream calls in flight, so the pool is sized well above the default.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+
+
+def create_openai_client(base_url=None, api_key=None) -> AsyncOpenAI:
+    """Create the application-wide async OpenAI client.
+
+    Args:
+        base_url (str, optional): Override the API base url (e.g. a local stand-in server).
+        api_key (str, optional): Override the API key, defaults to OPENAI_API_KEY.
+
+    Returns:
+        AsyncOpenAI: A client backed by a pooled, keep-alive HTTP connection pool. It does not
+            retry by itself, the calls go through the shared upstream limiter which does.
+    """
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+        event_hooks=upstream_event_hooks("openai"),
+    )
+    return AsyncOpenAI(
+        base_url=base_url or os.getenv("OPENAI_BASE_URL"),
+        api_key=api_key or os.getenv("OPENAI_API_KEY"),
+        http_client=http_client,
+        max_retries=0,
+    )
+
+
+def get_openai_client(request: Request) -> AsyncOpenAI:
+    """FastAPI dependency returning the client created in the app lifespan."""
+    return request.app.state.openai_client
@@ -0,0 +1,124 @@
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+
+IMAGE_OPEN = "!["
+ALT_CLOSE = "]("
+DATA_IMAGE_PREFIX = "data:image/"
+BASE64_MARKER = ";base64,"
+PLACEHOLDER_URL = "image://{}"
+
+
+class TextSegment(NamedTuple):
+    start: int
+    end: int
+
+
+class ImageRef(NamedTuple):
+    start: int  # offset of "!["
+    end: int  # offset after the closing ")"
+    alt_start: int
+    alt_end: int
+    url_start: int  # offset of "data:image/"
+    url_end: int  # offset of the closing ")"
+
+
+Segment = Union[TextSegment, ImageRef]
+
+
+def _match_image(content: str, open_idx: int) -> Tuple[Optional[ImageRef], int]:
+    """Match a base64 markdown image starting at open_idx.
+
+    Equivalent to the pattern !\\[(.*?)\\]\\((data:image\\/[^;]+;base64,[^)]+)\\) anchored at
+    open_idx, but using str.find so the base64 payload is scanned once and never copied.
+
+    Returns:
+        The image, or None, and the offset where the next image may start. When the match
+        fails for a reason that also rules out the following openers (the alt text reaches a
+        newline, nothing closes it), that offset skips past them, which keeps the scan linear
+        even for long lines holding many openers.
+    """
+    alt_start = open_idx + len(IMAGE_OPEN)
+    search_from = alt_start
+    while True:
+        alt_end = content.find(ALT_CLOSE, search_from)
+        if alt_end == -1:
+            return None, len(content)
+        # Like "." in the pattern, the alt text does not span lines. Openers before the
+        # newline would only reach the same candidates, so resume after it.
+        newline = content.find("\n", search_from, alt_end)
+        if newline != -1:
+            return None, newline + 1
+        # The alt text is non-greedy but may contain "](", so on failure try the next one
+        search_from = alt_end + 1
+        url_start = alt_end + len(ALT_CLOSE)
+        if not content.startswith(DATA_IMAGE_PREFIX, url_start):
+            continue
+        mime_start = url_start + len(DATA_IMAGE_PREFIX)
+        marker = content.find(";", mime_start)
+        if marker == -1:
+            return None, len(content)
+        if marker == mime_start or not content.startswith(BASE64_MARKER, marker):
+            continue
+        payload_start = marker + len(BASE64_MARKER)
+        url_end = content.find(")", payload_start)
+        if url_end == -1:
+            return None, len(content)
+        if url_end == payload_start:
+            continue  # empty payload
+        return ImageRef(open_idx, url_end + 1, alt_start, alt_end, url_start, url_end), url_end + 1
+
+
+def iter_image_refs(content: str) -> Iterator[ImageRef]:
+    """Yield the base64 markdown images of a document, in a single left to right pass."""
+    pos = 0
+    while True:
+        open_idx = content.find(IMAGE_OPEN, pos)
+        if open_idx == -1:
+            return
+        ref, resume = _match_image(content, open_idx)
+        if ref is not None:
+            yield ref
+        pos = max(resume, open_idx + 1)
+
+
+def scan_markdown(content: str) -> List[Segment]:
+    """Split a document into text segments and image references, by offset."""
+    segments = []
+    pos = 0
+    for ref in iter_image_refs(content):
+        if ref.start > pos:
+            segments.append(TextSegment(pos, ref.start))
+        segments.append(ref)
+        pos = ref.end
+    if pos < len(content):
+        segments.append(TextSegment(pos, len(content)))
+    return segments
+
+
+def markdown_text(content: str) -> str:
+    """The document without its embedded images, e.g. for narration."""
+    return "".join(content[s.start:s.end] for s in scan_markdown(content) if isinstance(s, TextSegment))
+
+
+def replace_images_with_placeholders(content: str) -> Tuple[str, List[ImageRef]]:
+    """Swap each embedded image URL for a short image://N placeholder.
+
+    Keeps the markdown structure visible to a model without sending the payloads as text.
+    """
+    parts = []
+    refs = []
+    pos = 0
+    for ref in iter_image_refs(content):
+        parts.append(content[pos:ref.url_start])
+        parts.append(PLACEHOLDER_URL.format(len(refs)))
+        refs.append(ref)
+        pos = ref.url_end
+    parts.append(content[pos:])
+    return "".join(parts), refs
+
+
+def restore_image_placeholders(text: str, content: str, refs: List[ImageRef]) -> str:
+    """Put the original image URLs from `content` back in place of the placeholders."""
+    for idx in reversed(range(len(refs))):
+        ref = refs[idx]
+        text = text.replace(f"({PLACEHOLDER_URL.format(idx)})", f"({content[ref.url_start:ref.url_end]})")
+    return text
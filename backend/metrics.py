@@ -0,0 +1,225 @@
+import atexit
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import httpx
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.routing import Match
+
+from tracing import span
+
+# From 10 ms to 10 minutes, video renders take minutes
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to serve a request, until its last body chunk is sent.",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests being served.", ["route"], multiprocess_mode="livesum"
+)
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_duration_seconds", "Duration of each generation pipeline stage.", ["stage"], buckets=STAGE_BUCKETS
+)
+STAGE_ERRORS = Counter("pipeline_stage_errors", "Pipeline stages that failed.", ["stage"])
+VIDEO_JOBS_IN_FLIGHT = Gauge(
+    "video_jobs_in_flight", "Video jobs waiting or running.", ["state"], multiprocess_mode="livesum"
+)
+UPSTREAM_CALL_SECONDS = Histogram(
+    "upstream_call_duration_seconds",
+    "Duration of each upstream call as seen by the pipeline, retries included.",
+    ["provider", "operation", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_CALL_ERRORS = Counter(
+    "upstream_call_errors", "Upstream calls that failed.", ["provider", "operation", "model"]
+)
+UPSTREAM_TOKENS = Counter("upstream_tokens", "Tokens used by model calls.", ["provider", "model", "kind"])
+UPSTREAM_HTTP_SECONDS = Histogram(
+    "upstream_http_request_duration_seconds",
+    "Time to the response headers of each HTTP attempt to an upstream.",
+    ["provider", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_HTTP_REQUEST_BYTES = Histogram(
+    "upstream_http_request_bytes", "Body size of each HTTP request sent upstream.", ["provider"], buckets=BYTES_BUCKETS
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries", "Upstream calls retried after a transient failure.", ["provider", "operation", "reason"]
+)
+UPSTREAM_COALESCED = Counter(
+    "upstream_coalesced_calls", "Calls served by an identical call already in flight.", ["provider", "operation"]
+)
+UPSTREAM_THROTTLE_SECONDS = Histogram(
+    "upstream_throttle_seconds",
+    "Time each upstream attempt waited for the rate limits and a concurrency slot.",
+    ["provider"],
+    buckets=LATENCY_BUCKETS,
+)
+DISK_CACHE_LOOKUPS = Counter("disk_cache_lookups", "Disk cache lookups, by result (hit or miss).", ["cache", "result"])
+DISK_CACHE_EVICTIONS = Counter("disk_cache_evictions", "Entries evicted from a disk cache.", ["cache"])
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "upstream_concurrency_limit", "Adaptive concurrency limit of each upstream.", ["provider"], multiprocess_mode="livesum"
+)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Record the duration of a pipeline stage, and count it as an error if it raises.
+
+    In traced requests the stage is also a span.
+    """
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def upstream_call(provider: str, operation: str, model: str = ""):
+    """Record the duration and failures of one logical upstream call, a span in traced requests."""
+    start = time.perf_counter()
+    try:
+        with span(f"{provider}.{operation}", model=model):
+            yield
+    except Exception:
+        UPSTREAM_CALL_ERRORS.labels(provider, operation, model).inc()
+        raise
+    finally:
+        UPSTREAM_CALL_SECONDS.labels(provider, operation, model).observe(time.perf_counter() - start)
+
+
+def record_usage(model: str, usage, provider: str = "openai"):
+    """Count the tokens of a completion, from its `usage` field."""
+    if usage is None:
+        return
+    UPSTREAM_TOKENS.labels(provider, model, "prompt").inc(usage.prompt_tokens or 0)
+    UPSTREAM_TOKENS.labels(provider, model, "completion").inc(usage.completion_tokens or 0)
+
+
+def upstream_event_hooks(provider: Optional[str] = None) -> dict:
+    """httpx event hooks timing every HTTP attempt to an upstream and the bytes it sends.
+
+    Args:
+        provider (str, optional): Label of the upstream, defaults to the host of each request.
+    """
+
+    async def on_request(request: httpx.Request):
+        request.extensions["metrics_start"] = time.perf_counter()
+        label = provider or request.url.host
+        UPSTREAM_HTTP_REQUEST_BYTES.labels(label).observe(int(request.headers.get("content-length", 0)))
+
+    async def on_response(response: httpx.Response):
+        start = response.request.extensions.get("metrics_start")
+        if start is not None:
+            label = provider or response.request.url.host
+            UPSTREAM_HTTP_SECONDS.labels(label, str(response.status_code)).observe(time.perf_counter() - start)
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def route_template(scope) -> str:
+    """Path template of the route handling a request (e.g. /video-jobs/{job_id}), to bound label values."""
+    app = scope.get("app")
+    if app is not None:
+        for route in app.router.routes:
+            match, _ = route.matches(scope)
+            if match != Match.NONE:
+                return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request latency and in-flight requests per route.
+
+    Streaming responses are timed until their last body chunk, not just their headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = route_template(scope)
+        status = "500"
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.labels(route).inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.labels(route).dec()
+            HTTP_REQUEST_SECONDS.labels(route, scope["method"], status).observe(time.perf_counter() - start)
+
+
+def init_pool_process():
+    """Initializer of the process pools, their processes record metrics like the web workers.
+
+    gunicorn only cleans up after its own workers (child_exit), so with
+    PROMETHEUS_MULTIPROC_DIR set a pool process removes its live gauge files itself
+    when it exits. The pools use spawn, whose processes run atexit handlers.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        atexit.register(multiprocess.mark_process_dead, os.getpid())
+
+
+def _registry() -> CollectorRegistry:
+    """Registry of every process' metrics with PROMETHEUS_MULTIPROC_DIR set, of this process otherwise."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_payload() -> bytes:
+    """Current metrics in the Prometheus text format.
+
+    With PROMETHEUS_MULTIPROC_DIR set, the metrics of every worker process are aggregated.
+    """
+    return generate_latest(_registry())
+
+
+def counter_totals(name: str, label: str, **labels) -> Dict[str, float]:
+    """Values of a counter by one of its labels, among the samples matching `labels`.
+
+    With PROMETHEUS_MULTIPROC_DIR set they are summed over every process, the render and
+    image pools included.
+    """
+    totals = {}
+    for metric in _registry().collect():
+        for sample in metric.samples:
+            if sample.name != f"{name}_total":
+                continue
+            if all(sample.labels.get(key) == value for key, value in labels.items()):
+                value = sample.labels.get(label, "")
+                totals[value] = totals.get(value, 0.0) + sample.value
+    return totals
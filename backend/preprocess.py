@@ -0,0 +1,116 @@
+import asyncio
+import base64
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from PIL import Image, ImageOps
+
+from metrics import init_pool_process
+
+# Longest side sent to the vision model. gpt-4o rescales high detail images so the
+# short side is at most 768px, anything larger only costs upload time.
+VISION_IMAGE_MAX_SIZE = int(os.getenv("VISION_IMAGE_MAX_SIZE", "1024"))
+VISION_IMAGE_FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG").upper()
+VISION_IMAGE_QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "85"))
+VISION_IMAGE_DETAIL = os.getenv("VISION_IMAGE_DETAIL", "auto")
+# Every web worker of a host (WEB_CONCURRENCY) has its own pool, each gets its share of the CPUs
+IMAGE_WORKERS = int(os.getenv(
+    "IMAGE_WORKERS", str(max(1, (os.cpu_count() or 1) // max(1, int(os.getenv("WEB_CONCURRENCY", "1")))))
+))
+
+DETAIL_LEVELS = ("low", "high", "auto")
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+if VISION_IMAGE_FORMAT not in MIME_TYPES:
+    raise ValueError(f"Invalid VISION_IMAGE_FORMAT '{VISION_IMAGE_FORMAT}', expected one of {', '.join(MIME_TYPES)}.")
+
+
+class VisionImage(NamedTuple):
+    data_url: str
+    detail: str
+    size: int  # bytes of the encoded image
+
+
+def downscale_image(
+    data: bytes,
+    max_size: int = VISION_IMAGE_MAX_SIZE,
+    image_format: str = VISION_IMAGE_FORMAT,
+    quality: int = VISION_IMAGE_QUALITY,
+) -> bytes:
+    """Resize an image to fit within max_size x max_size and re-encode it.
+
+    Args:
+        data (bytes): The original image file.
+        max_size (int): Longest side of the output, in pixels.
+        image_format (str): Output format, JPEG, WEBP or PNG.
+        quality (int): Encoder quality for lossy formats.
+
+    Returns:
+        bytes: The encoded, downscaled image.
+    """
+    image = Image.open(io.BytesIO(data))
+    # draft lets the JPEG decoder skip most of the work for large downscales
+    image.draft("RGB", (max_size, max_size))
+    # Phone photos store their rotation in EXIF, apply it before dropping the metadata
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("RGBA" if image_format == "PNG" and image.mode in ("RGBA", "LA", "P") else "RGB")
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def parse_detail(detail: Optional[str], count: int) -> List[str]:
+    """Expand a detail form value into one level per image.
+
+    Accepts a single level applied to every image, or a comma separated list with one level per image.
+    """
+    levels = [level.strip().lower() for level in (detail or VISION_IMAGE_DETAIL).split(",")]
+    if len(levels) == 1:
+        levels = levels * count
+    if len(levels) != count:
+        raise ValueError(f"Expected 1 or {count} detail levels, got {len(levels)}.")
+    for level in levels:
+        if level not in DETAIL_LEVELS:
+            raise ValueError(f"Invalid detail level '{level}', expected one of {', '.join(DETAIL_LEVELS)}.")
+    return levels
+
+
+def create_image_pool(workers: int = IMAGE_WORKERS) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_pool_process
+    )
+
+
+async def prepare_vision_images(
+    executor: ProcessPoolExecutor,
+    images: List[bytes],
+    details: List[str],
+    max_size: int = VISION_IMAGE_MAX_SIZE,
+    image_format: str = VISION_IMAGE_FORMAT,
+    quality: int = VISION_IMAGE_QUALITY,
+) -> List[VisionImage]:
+    """Downscale images across the process pool and wrap them as data URLs for the model."""
+    loop = asyncio.get_running_loop()
+    encoded = await asyncio.gather(
+        *(loop.run_in_executor(executor, downscale_image, data, max_size, image_format, quality) for data in images)
+    )
+    mime_type = MIME_TYPES[image_format]
+    return [
+        VisionImage(f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}", detail, len(data))
+        for data, detail in zip(encoded, details)
+    ]
+
+
+def image_content_parts(vision_images: List[VisionImage]) -> List[dict]:
+    """Chat message content parts, one per image."""
+    return [
+        {"type": "image_url", "image_url": {"url": image.data_url, "detail": image.detail}}
+        for image in vision_images
+    ]
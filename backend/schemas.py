@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Literal, Optional
 
 from pydantic import BaseModel
 
@@ -15,6 +15,10 @@ class Instruction(BaseModel):
 
 class CleanedText(BaseModel):
     cleaned_text: str
+
+class CleanedTexts(BaseModel):
+    cleaned_texts: list[str]
+
 class ImproveTextRequest(BaseModel):
     description: str
     improveText: str
@@ -26,6 +30,24 @@ class SearchQuery(BaseModel):
 class VideoRequest(BaseModel):
     images: List[str]  # List of base64 encoded images
     descriptions: List[str] 
+    batch_cleaning: bool = False  # Clean all descriptions in a single LLM call
+    response_mode: Literal["file", "base64"] = "file"  # Stream the mp4, or return a base64 data URL
 
 class VideoResponse(BaseModel):
-    video: str  # base64 encoded video with data URL prefix
\ No newline at end of file
+    video: str  # base64 encoded video with data URL prefix
+
+class VideoJobCreated(BaseModel):
+    job_id: str
+    status_url: str
+    result_url: str
+
+class VideoJobStatus(BaseModel):
+    job_id: str
+    status: str  # queued, running, done or failed
+    stage: str  # current pipeline stage, see jobs.STAGES
+    progress: float  # 0.0 to 1.0
+    pages: int
+    reused_pages: int = 0  # pages served from the segment cache
+    created_at: float
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Optional, Tuple
+
+from disk_cache import DiskCache
+
+SEGMENT_CACHE_DIR = os.getenv("SEGMENT_CACHE_DIR", "./output/segment_cache")
+SEGMENT_CACHE_MAX_BYTES = int(os.getenv("SEGMENT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+SEGMENT_SUFFIX = ".mp4"
+SEGMENT_RENDER_CONCURRENCY = int(os.getenv("SEGMENT_RENDER_CONCURRENCY", "2"))
+
+
+def workspace_segment_path(output_dir: str, idx: int) -> str:
+    """Where the segment of a page lives while a video is assembled."""
+    return os.path.join(output_dir, "temp", "segments", f"segment_{idx}{SEGMENT_SUFFIX}")
+
+
+def segment_cache_key(image: bytes, text: str, voice: str, frame_size: Tuple[int, int], narration: str = "verbatim") -> str:
+    """Content address of a rendered page: its image, its text, the voice and the encoding.
+
+    Args:
+        image (bytes): The encoded page image.
+        text (str): The page description the narration is made from.
+        voice (str): Identity of the speech voice, see tts.speech_voice_id.
+        frame_size (tuple of int): Output (width, height); segments only join if it matches.
+        narration (str): How the text becomes narration, e.g. the cleaning model and prompt.
+    """
+    # The video stack is loaded on first use, not when the API starts
+    from video import AUDIO_CODEC_ARGS, VIDEO_CODEC_ARGS
+
+    payload = json.dumps(
+        [
+            hashlib.sha256(image).hexdigest(),
+            hashlib.sha256(text.encode("utf-8")).hexdigest(),
+            voice,
+            list(frame_size),
+            narration,
+            VIDEO_CODEC_ARGS,
+            AUDIO_CODEC_ARGS,
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SegmentCache(DiskCache):
+    """Size-capped LRU cache of rendered page segments (one still image with its narration).
+
+    Segments all share the encoder settings, so a video is assembled by joining them
+    at the stream level and only edited pages are ever rendered again.
+    """
+
+    name = "segments"
+
+    def __init__(self, directory: str = SEGMENT_CACHE_DIR, max_bytes: int = SEGMENT_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def link(self, key: str, dest: str) -> Optional[float]:
+        """Hard-link a cached segment to dest and return its duration, or None on a miss.
+
+        The link keeps the segment readable for the caller even if it is evicted later.
+        """
+        with self.lock:
+            meta = self._read_meta(key)
+            if meta is not None:
+                try:
+                    source = os.path.join(self.directory, meta["file"])
+                    try:
+                        os.link(source, dest)
+                    except OSError:
+                        # Different filesystem or no hard link support
+                        shutil.copyfile(source, dest)
+                except OSError:
+                    meta = None
+
+            if meta is None:
+                self._count("miss")
+                if key in self.entries:
+                    self._remove(key)
+                return None
+
+            self._count("hit")
+            if key not in self.entries:
+                # Written by another process sharing the cache directory
+                self.entries[key] = meta["size"]
+                self.total_bytes += meta["size"]
+            self.entries.move_to_end(key)
+            self._touch(key)
+            return meta["duration"]
+
+    def put_segment(self, key: str, path: str, duration: float):
+        with open(path, "rb") as f:
+            self.put(key, f.read(), {"duration": duration}, suffix=SEGMENT_SUFFIX)
+
+
+_segment_cache = None
+_segment_cache_lock = threading.Lock()
+
+
+def get_segment_cache() -> SegmentCache:
+    """Return the process-wide segment cache."""
+    global _segment_cache
+    with _segment_cache_lock:
+        if _segment_cache is None:
+            _segment_cache = SegmentCache()
+        return _segment_cache
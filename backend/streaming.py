@@ -0,0 +1,113 @@
+import json
+import os
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+FILE_CHUNK_SIZE = 256 * 1024
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single HTTP byte range into inclusive (start, end) offsets.
+
+    Returns None when the header is not a byte range we serve, so the whole file is sent.
+    Raises HTTPException 416 when the range cannot be satisfied.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges:
+        return None
+    # Multiple ranges are answered with the first one only
+    first = ranges.split(",")[0].strip()
+    start_str, _, end_str = first.partition("-")
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(0, file_size - int(end_str))
+            end = file_size - 1
+    except ValueError:
+        return None
+
+    end = min(end, file_size - 1)
+    if start > end or start >= file_size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"},
+        )
+    return start, end
+
+
+def iter_file(path: str, start: int, length: int, chunk_size: int = FILE_CHUNK_SIZE):
+    """Yield `length` bytes of a file from `start`, one chunk at a time."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(
+    path: str,
+    range_header: Optional[str] = None,
+    media_type: str = "application/octet-stream",
+    filename: Optional[str] = None,
+    background: Optional[BackgroundTask] = None,
+) -> StreamingResponse:
+    """Stream a file from disk in chunks, honouring an HTTP Range header.
+
+    Args:
+        path (str): The file to send.
+        range_header (str, optional): The request's Range header.
+        media_type (str): Content type of the file.
+        filename (str, optional): Download name sent in Content-Disposition.
+        background (BackgroundTask, optional): Runs once the response has been sent, e.g. cleanup.
+
+    Returns:
+        StreamingResponse: A 200 response with the whole file, or 206 with the requested range.
+    """
+    file_size = os.path.getsize(path)
+    headers = {"Accept-Ranges": "bytes"}
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    byte_range = parse_range_header(range_header, file_size) if range_header else None
+    if byte_range is None:
+        start, end, status_code = 0, file_size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+
+    # A sync iterator is consumed in the threadpool, so file reads do not block the event loop
+    return StreamingResponse(
+        iter_file(path, start, length),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+        background=background,
+    )
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Format one server-sent event."""
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # Stop reverse proxies from buffering the stream
+    "X-Accel-Buffering": "no",
+}
@@ -0,0 +1,81 @@
+import os
+import time
+
+from disk_cache import DiskCache
+from upload_cache import UploadCache
+
+ENTRY = b"x" * 100
+
+
+class LRUTestCache(DiskCache):
+    name = "test_lru"
+
+
+def _age(cache, key, seconds):
+    """Make an entry look last used `seconds` ago."""
+    then = time.time() - seconds
+    os.utime(cache._meta_path(key), (then, then))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = LRUTestCache(str(tmp_path), max_bytes=350)
+    for key, age in (("a", 30), ("b", 20), ("c", 10)):
+        cache.put(key, ENTRY)
+        _age(cache, key, age)
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a")[0] == ENTRY
+    cache.put("d", ENTRY)
+
+    assert cache.get("b") is None
+    for key in ("a", "c", "d"):
+        assert cache.get(key)[0] == ENTRY
+    assert not os.path.exists(tmp_path / "b.bin")
+    assert cache.stats()["bytes"] == 300
+
+
+def test_stays_under_the_cap(tmp_path):
+    cache = LRUTestCache(str(tmp_path), max_bytes=1000)
+    for i in range(50):
+        cache.put(f"k{i}", ENTRY)
+        assert cache.stats()["bytes"] <= 1000
+    # Entries larger than the cache are not stored
+    cache.put("huge", b"x" * 1001)
+    assert cache.get("huge") is None
+
+
+def test_index_is_shared_through_the_directory(tmp_path):
+    writer = LRUTestCache(str(tmp_path), max_bytes=350)
+    reader = LRUTestCache(str(tmp_path), max_bytes=350)
+    writer.put("a", ENTRY, {"kind": "test"})
+    data, meta = reader.get("a")
+    assert data == ENTRY and meta["kind"] == "test"
+    # A new instance, e.g. after a restart, finds the entries on disk
+    assert len(LRUTestCache(str(tmp_path), max_bytes=350).entries) == 1
+
+
+def test_counts_hits_misses_and_evictions(tmp_path):
+    class CountingCache(DiskCache):
+        name = "test_counts"
+
+    cache = CountingCache(str(tmp_path), max_bytes=250)
+    before = cache.stats()
+    cache.put("a", ENTRY)
+    cache.get("a")
+    cache.get("missing")
+    cache.put("b", ENTRY)
+    cache.put("c", ENTRY)
+    after = cache.stats()
+    assert after["hits"] - before["hits"] == 1
+    assert after["misses"] - before["misses"] == 1
+    assert after["evictions"] - before["evictions"] == 1
+    assert after["entries"] == 2
+
+
+def test_expired_entries_are_removed(tmp_path):
+    cache = UploadCache(str(tmp_path), max_bytes=10000, ttl=0.2)
+    cache.put("key", ["step 1", "step 2"])
+    assert cache.get("key") == ["step 1", "step 2"]
+    time.sleep(0.3)
+    assert cache.get("key") is None
+    # Both the data file and its sidecar are gone
+    assert [name for name in os.listdir(tmp_path) if not name.startswith(".")] == []
@@ -0,0 +1,56 @@
+import random
+import re
+
+from benchmarks.markdown_images import IMAGE_PATTERN, synthetic_document
+from helpers import extract_images_from_markdown
+from markdown_scan import (
+    iter_image_refs,
+    markdown_text,
+    replace_images_with_placeholders,
+    restore_image_placeholders,
+)
+
+# Fragments that exercise every branch of the scanner when concatenated at random
+FRAGMENTS = ["![", "](", "data:image/", "png", ";", ";base64,", "QUJD", ")", "\n", "a", "]", "(", "!", " "]
+
+
+def _regex_refs(content):
+    return [
+        (m.start(), m.end(), m.start(1), m.end(1), m.start(2), m.end(2))
+        for m in re.finditer(IMAGE_PATTERN, content)
+    ]
+
+
+def _scan_refs(content):
+    return [tuple(ref) for ref in iter_image_refs(content)]
+
+
+def test_matches_old_regex_on_random_documents():
+    rng = random.Random(0)
+    for _ in range(20000):
+        content = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 30)))
+        assert _scan_refs(content) == _regex_refs(content), repr(content)
+
+
+def test_matches_old_regex_on_synthetic_documents():
+    for single_line in (False, True):
+        content = synthetic_document(0.1, image_kb=4, single_line=single_line)
+        refs = _scan_refs(content)
+        assert refs
+        assert refs == _regex_refs(content)
+        assert extract_images_from_markdown(content) == [m.group(0) for m in re.finditer(IMAGE_PATTERN, content)]
+
+
+def test_alt_text_does_not_span_lines():
+    content = "![broken\n![ok](data:image/png;base64,QUJD)"
+    assert _scan_refs(content) == _regex_refs(content)
+    assert extract_images_from_markdown(content) == ["![ok](data:image/png;base64,QUJD)"]
+
+
+def test_placeholders_round_trip():
+    content = "Intro ![a](data:image/png;base64,QUJD) middle ![b](data:image/jpeg;base64,REVG) end"
+    text, refs = replace_images_with_placeholders(content)
+    assert "base64" not in text
+    assert len(refs) == 2
+    assert restore_image_placeholders(text, content, refs) == content
+    assert "QUJD" not in markdown_text(content)
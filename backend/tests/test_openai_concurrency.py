@@ -0,0 +1,32 @@
+"""The shared async OpenAI client keeps many calls in flight against the stand-in server."""
+import asyncio
+import time
+
+from benchmarks.standins import BackgroundServer, make_openai_app
+from helpers import clean_descriptions
+from llm import create_openai_client
+
+LATENCY = 0.3
+N_REQUESTS = 20
+
+
+async def _clean(base_url: str, n_requests: int):
+    client = create_openai_client(base_url=f"{base_url}/v1", api_key="stand-in")
+    try:
+        return await clean_descriptions(client, [f"step {i}" for i in range(n_requests)], concurrency=n_requests)
+    finally:
+        await client.close()
+
+
+def test_shared_client_calls_overlap():
+    app = make_openai_app(latency=LATENCY)
+    with BackgroundServer(app) as server:
+        start = time.perf_counter()
+        cleaned = asyncio.run(_clean(server.url, N_REQUESTS))
+        elapsed = time.perf_counter() - start
+
+    assert cleaned == [f"Now, step {i}" for i in range(N_REQUESTS)]
+    assert app.state.requests == N_REQUESTS
+    # Serially this would take N_REQUESTS latencies
+    assert app.state.max_in_flight > N_REQUESTS // 2
+    assert elapsed < N_REQUESTS * LATENCY / 4
@@ -0,0 +1,32 @@
+import pytest
+from fastapi import HTTPException
+
+from streaming import parse_range_header
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=0-0", (0, 0)),
+        ("BYTES = 10-19", (10, 19)),
+        ("bytes=10-19, 30-39", (10, 19)),
+        ("items=0-99", None),
+        ("bytes=", None),
+        ("bytes=a-b", None),
+    ],
+)
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=1500-2000", "bytes=50-10"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(HTTPException) as excinfo:
+        parse_range_header(header, 1000)
+    assert excinfo.value.status_code == 416
+    assert excinfo.value.headers["Content-Range"] == "bytes */1000"
@@ -0,0 +1,131 @@
+import asyncio
+
+import httpx
+import pytest
+
+from upstream import (
+    UPSTREAM_BACKOFF_MAX,
+    AdaptiveConcurrency,
+    TokenBucket,
+    UpstreamLimiter,
+)
+
+
+def _status_error(status, headers=None):
+    request = httpx.Request("POST", "https://upstream.test/v1/chat/completions")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return httpx.HTTPStatusError(f"{status}", request=request, response=response)
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket(0)
+    assert bucket.reserve(10 ** 9) == 0.0
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(per_minute=60)  # one unit per second, burst of 60
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(30) == pytest.approx(30, abs=0.5)
+    # The next caller queues behind the previous reservation
+    assert bucket.reserve(1) == pytest.approx(31, abs=0.5)
+
+
+def test_token_bucket_refund():
+    bucket = TokenBucket(per_minute=60)
+    bucket.reserve(60)
+    bucket.refund(20)
+    assert bucket.reserve(20) == pytest.approx(0, abs=0.1)
+    # Refunds never go beyond the burst capacity
+    bucket.refund(1000)
+    assert bucket.level == pytest.approx(60, abs=0.1)
+
+
+def test_concurrency_halves_on_overload_once_per_interval():
+    concurrency = AdaptiveConcurrency("test_overload", maximum=16, minimum=2, decrease_interval=60)
+    for _ in range(3):
+        concurrency.acquire_sync()
+    for _ in range(3):
+        concurrency.release("overload")
+    assert concurrency.limit == 8
+    assert concurrency.in_flight == 0
+
+    concurrency.decrease_interval = 0
+    for _ in range(5):
+        concurrency.acquire_sync()
+        concurrency.release("overload")
+    assert concurrency.limit == 2
+
+
+def test_concurrency_grows_back_on_success():
+    concurrency = AdaptiveConcurrency("test_growth", maximum=4, decrease_interval=0)
+    concurrency.acquire_sync()
+    concurrency.release("overload")
+    concurrency.acquire_sync()
+    concurrency.release("overload")
+    assert concurrency.limit == 1
+    # The limit only grows while all of it is in use
+    concurrency.acquire_sync()
+    concurrency.release("success")
+    assert concurrency.limit == 2
+    for _ in range(3):
+        concurrency.acquire_sync()
+        concurrency.release("success")
+    assert concurrency.limit == 2
+    for _ in range(20):
+        slots = int(concurrency.limit)
+        for _ in range(slots):
+            concurrency.acquire_sync()
+        for _ in range(slots):
+            concurrency.release("success")
+    assert concurrency.limit == 4
+    # Errors that are not overload leave the limit alone
+    concurrency.acquire_sync()
+    concurrency.release("error")
+    assert concurrency.limit == 4
+
+
+def test_concurrency_bounds_calls_in_flight():
+    concurrency = AdaptiveConcurrency("test_bound", maximum=3)
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    async def call():
+        await concurrency.acquire()
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            state["in_flight"] -= 1
+            concurrency.release("error")
+
+    async def main():
+        await asyncio.gather(*(call() for _ in range(20)))
+
+    asyncio.run(main())
+    assert state["max_in_flight"] == 3
+    assert concurrency.in_flight == 0
+    assert not concurrency.waiters
+
+
+def test_retry_delay_respects_retry_after():
+    limiter = UpstreamLimiter("test_retry", max_attempts=4)
+    for attempt in range(3):
+        assert limiter.retry_delay(_status_error(429, {"Retry-After": "2"}), attempt, "test") >= 2
+    assert 0 <= limiter.retry_delay(_status_error(503), 0, "test") <= 0.5
+
+
+def test_retry_delay_gives_up():
+    limiter = UpstreamLimiter("test_give_up", max_attempts=3)
+    # Out of attempts
+    assert limiter.retry_delay(_status_error(429), 2, "test") is None
+    # Client errors are not retried
+    assert limiter.retry_delay(_status_error(400), 0, "test") is None
+    assert limiter.retry_delay(ValueError("bad input"), 0, "test") is None
+    # A Retry-After beyond the longest backoff fails the call instead of holding it
+    headers = {"Retry-After": str(int(UPSTREAM_BACKOFF_MAX) + 60)}
+    assert limiter.retry_delay(_status_error(429, headers), 0, "test") is None
+
+
+def test_retry_delay_on_timeouts():
+    limiter = UpstreamLimiter("test_timeout", max_attempts=2)
+    assert limiter.retry_delay(httpx.ReadTimeout("timed out"), 0, "test") is not None
@@ -0,0 +1,42 @@
+from vision import owned_range, plan_windows, stitch_windows
+
+
+def _window_results(windows):
+    """Descriptions a window would get back, naming the window and the image."""
+    return [[f"{k}:{idx}" for idx in range(start, end)] for k, (start, end) in enumerate(windows)]
+
+
+def test_windows_cover_every_image():
+    for n_images in range(1, 60):
+        for size in range(1, 13):
+            for overlap in range(0, size + 2):
+                windows = plan_windows(n_images, size, overlap)
+                assert windows[0][0] == 0
+                assert windows[-1][1] == n_images
+                assert all(0 < end - start <= size for start, end in windows)
+                # Consecutive windows touch or overlap, so no image is left out
+                assert all(nxt[0] <= end for (_, end), nxt in zip(windows, windows[1:]))
+
+
+def test_stitch_keeps_one_description_per_image():
+    for n_images in range(1, 60):
+        for size in range(1, 13):
+            for overlap in range(0, size + 2):
+                windows = plan_windows(n_images, size, overlap)
+                instructions = stitch_windows(windows, _window_results(windows))
+                assert [int(d.split(":")[1]) for d in instructions] == list(range(n_images))
+                owned = [owned_range(windows, k) for k in range(len(windows))]
+                assert owned[0][0] == 0 and owned[-1][1] == n_images
+                assert all(a[1] == b[0] for a, b in zip(owned, owned[1:]))
+
+
+def test_overlap_is_split_at_its_middle():
+    windows = plan_windows(20, size=10, overlap=4)
+    assert windows == [(0, 10), (6, 16), (12, 20)]
+    instructions = stitch_windows(windows, _window_results(windows))
+    assert instructions[7] == "0:7" and instructions[8] == "1:8"
+
+
+def test_single_window():
+    assert plan_windows(3, size=10, overlap=2) == [(0, 3)]
+    assert stitch_windows([(0, 3)], [["a", "b", "c"]]) == ["a", "b", "c"]
@@ -0,0 +1,376 @@
+import hmac
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import List, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+# Share of requests traced without the debug header
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Also take a CPU profile of sampled requests (the debug header asks for it with "profile")
+TRACE_PROFILE = os.getenv("TRACE_PROFILE", "false").lower() in ("1", "true", "yes")
+TRACE_PROFILE_INTERVAL = float(os.getenv("TRACE_PROFILE_INTERVAL", "0.005"))
+TRACE_MAX_STORED = int(os.getenv("TRACE_MAX_STORED", "100"))
+# When set, traces are stored there instead of in memory, so every worker process serves
+# them, each one also as a Chrome trace file (chrome://tracing, Perfetto)
+TRACE_DIR = os.getenv("TRACE_DIR")
+# The debug header and the trace endpoints require X-Debug-Token to match, they are disabled when unset
+TRACE_DEBUG_TOKEN = os.getenv("TRACE_DEBUG_TOKEN")
+TRACE_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+TRACE_HEADER = b"x-debug-trace"
+TOKEN_HEADER = b"x-debug-token"
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "attrs", "start", "end", "error", "children")
+
+    def __init__(self, name: str, attrs: Optional[dict] = None, start: Optional[float] = None, end: Optional[float] = None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter() if start is None else start
+        self.end = end
+        self.error = None
+        self.children: List[Span] = []
+
+    def to_dict(self, origin: float) -> dict:
+        end = self.end if self.end is not None else time.perf_counter()
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "attrs": self.attrs,
+            "error": self.error,
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+class span:
+    """Time a block as a child of the current span. Outside traced requests it does nothing.
+
+    Usage:
+        with span("decode", pages=3):
+            ...
+    """
+
+    __slots__ = ("name", "attrs", "span", "token")
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span = None
+
+    def __enter__(self) -> Optional[Span]:
+        parent = _current_span.get()
+        if parent is None:
+            return None
+        self.span = Span(self.name, self.attrs)
+        parent.children.append(self.span)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        self.span.end = time.perf_counter()
+        if exc is not None:
+            self.span.error = repr(exc)
+        try:
+            _current_span.reset(self.token)
+        except ValueError:
+            pass  # exited from another context, e.g. a streamed response body
+        return False
+
+
+def add_span(name: str, start: float, end: float, **attrs):
+    """Attach an already measured block (e.g. timed in a worker process) to the current span."""
+    parent = _current_span.get()
+    if parent is not None:
+        parent.children.append(Span(name, attrs, start, end))
+
+
+class StackSampler:
+    """Sampling CPU profiler of one thread, aggregated as folded stacks.
+
+    The samples cover everything running on that thread, for the event loop thread
+    that includes other requests served at the same time. Work handed to thread or
+    process pools is not sampled.
+    """
+
+    def __init__(self, thread_id: int, interval: float = TRACE_PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def folded(self) -> str:
+        """Samples in the folded format read by flamegraph.pl and speedscope."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.most_common())
+
+
+class Trace:
+    def __init__(self, name: str, profile: bool = False):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.root = Span(name)
+        self.status = None
+        self.sampler = StackSampler(threading.get_ident()) if profile else None
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def finish(self):
+        self.root.end = time.perf_counter()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def summary(self) -> dict:
+        end = self.root.end if self.root.end is not None else time.perf_counter()
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "started_at": self.started_at,
+            "duration_ms": round((end - self.root.start) * 1000, 3),
+            "status": self.status,
+            "profiled": self.sampler is not None,
+        }
+
+    def to_dict(self) -> dict:
+        return {**self.summary(), "spans": self.root.to_dict(self.root.start)}
+
+    def chrome_trace(self) -> dict:
+        """The span tree as Chrome trace events, one complete event per span."""
+        events = []
+        pending = [self.root]
+        while pending:
+            current = pending.pop()
+            end = current.end if current.end is not None else time.perf_counter()
+            events.append({
+                "name": current.name,
+                "ph": "X",
+                "ts": round((current.start - self.root.start) * 1e6, 1),
+                "dur": round((end - current.start) * 1e6, 1),
+                "pid": 1,
+                "tid": 1,
+                "args": {**current.attrs, **({"error": current.error} if current.error else {})},
+            })
+            pending.extend(current.children)
+        return {"traceEvents": events, "otherData": self.summary()}
+
+    def profile(self) -> Optional[str]:
+        return self.sampler.folded() if self.sampler is not None else None
+
+
+class TraceStore:
+    """The most recent traces, in memory."""
+
+    def __init__(self, max_entries: int = TRACE_MAX_STORED):
+        self.max_entries = max_entries
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, trace: Trace):
+        with self.lock:
+            self.traces[trace.trace_id] = trace
+            while len(self.traces) > self.max_entries:
+                self.traces.popitem(last=False)
+
+    def _get(self, trace_id: str) -> Optional[Trace]:
+        with self.lock:
+            return self.traces.get(trace_id)
+
+    def list(self) -> List[dict]:
+        with self.lock:
+            return [trace.summary() for trace in reversed(self.traces.values())]
+
+    def tree(self, trace_id: str) -> Optional[dict]:
+        trace = self._get(trace_id)
+        return trace.to_dict() if trace is not None else None
+
+    def chrome(self, trace_id: str) -> Optional[dict]:
+        trace = self._get(trace_id)
+        return trace.chrome_trace() if trace is not None else None
+
+    def profile(self, trace_id: str) -> Optional[str]:
+        trace = self._get(trace_id)
+        return trace.profile() if trace is not None else None
+
+
+class TraceDirectory:
+    """Traces stored as files in a directory shared by the worker processes.
+
+    Each trace is a Chrome trace file ({id}.json), its span tree ({id}.tree) and, when
+    profiled, its folded stacks ({id}.folded). The Chrome trace is written last, it marks
+    a complete trace. Only the `max_entries` most recent traces are kept.
+    """
+
+    SUFFIXES = (".json", ".tree", ".folded")
+
+    def __init__(self, directory: str, max_entries: int = TRACE_MAX_STORED):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, trace_id: str, suffix: str) -> Optional[str]:
+        if not TRACE_ID_PATTERN.fullmatch(trace_id):
+            return None
+        return os.path.join(self.directory, f"{trace_id}{suffix}")
+
+    def _read(self, trace_id: str, suffix: str) -> Optional[str]:
+        path = self._path(trace_id, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _recent_ids(self) -> List[str]:
+        """Ids of the complete traces, newest first."""
+        recent = []
+        for filename in os.listdir(self.directory):
+            trace_id, suffix = os.path.splitext(filename)
+            if suffix == ".json" and TRACE_ID_PATTERN.fullmatch(trace_id):
+                try:
+                    recent.append((os.path.getmtime(os.path.join(self.directory, filename)), trace_id))
+                except OSError:
+                    continue  # removed by another worker meanwhile
+        recent.sort(reverse=True)
+        return [trace_id for _, trace_id in recent]
+
+    def add(self, trace: Trace):
+        """Write the trace files and remove the oldest traces beyond max_entries, this blocks on disk I/O."""
+        # disk_cache records metrics, whose module imports this one
+        from disk_cache import atomic_write
+
+        atomic_write(self._path(trace.trace_id, ".tree"), json.dumps(trace.to_dict()).encode("utf-8"))
+        write_trace_file(trace, self.directory)
+        for trace_id in self._recent_ids()[self.max_entries:]:
+            for suffix in self.SUFFIXES:
+                try:
+                    os.remove(self._path(trace_id, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def list(self) -> List[dict]:
+        summaries = []
+        for trace_id in self._recent_ids()[: self.max_entries]:
+            chrome = self.chrome(trace_id)
+            if chrome is not None:
+                summaries.append(chrome["otherData"])
+        return summaries
+
+    def tree(self, trace_id: str) -> Optional[dict]:
+        data = self._read(trace_id, ".tree")
+        return json.loads(data) if data is not None else None
+
+    def chrome(self, trace_id: str) -> Optional[dict]:
+        data = self._read(trace_id, ".json")
+        return json.loads(data) if data is not None else None
+
+    def profile(self, trace_id: str) -> Optional[str]:
+        return self._read(trace_id, ".folded")
+
+
+def write_trace_file(trace: Trace, directory: str):
+    from disk_cache import atomic_write
+
+    os.makedirs(directory, exist_ok=True)
+    atomic_write(os.path.join(directory, f"{trace.trace_id}.json"), json.dumps(trace.chrome_trace()).encode("utf-8"))
+    profile = trace.profile()
+    if profile is not None:
+        atomic_write(os.path.join(directory, f"{trace.trace_id}.folded"), profile.encode("utf-8"))
+
+
+trace_store = TraceDirectory(TRACE_DIR) if TRACE_DIR else TraceStore()
+
+
+def debug_token_valid(token: Optional[str]) -> bool:
+    """Whether a request may use the debug header and endpoints, never without TRACE_DEBUG_TOKEN."""
+    if TRACE_DEBUG_TOKEN is None or token is None:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), TRACE_DEBUG_TOKEN.encode("utf-8"))
+
+
+class TracingMiddleware:
+    """ASGI middleware tracing requests that ask for it (X-Debug-Trace: 1 or profile) or are sampled.
+
+    The debug header is honoured only with the X-Debug-Token matching TRACE_DEBUG_TOKEN.
+    Traced responses carry an X-Trace-Id header, the trace is then available from the
+    /debug/traces endpoints and, with TRACE_DIR set, as files. Other requests only pay
+    for a header lookup.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def trace_mode(scope) -> Optional[str]:
+        """None, "trace" or "profile"."""
+        requested = token = None
+        for name, value in scope["headers"]:
+            if name == TRACE_HEADER:
+                requested = value.decode("latin-1").strip().lower()
+            elif name == TOKEN_HEADER:
+                token = value.decode("latin-1")
+        if requested and requested not in ("0", "false") and debug_token_valid(token):
+            return "profile" if requested == "profile" else "trace"
+        if TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE:
+            return "profile" if TRACE_PROFILE else "trace"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        mode = self.trace_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}", profile=mode == "profile")
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode("ascii"))]
+            await send(message)
+
+        token = _current_span.set(trace.root)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            trace.root.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            trace.finish()
+            if isinstance(trace_store, TraceDirectory):
+                await run_in_threadpool(trace_store.add, trace)
+            else:
+                trace_store.add(trace)
@@ -0,0 +1,168 @@
+import io
+import math
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from upstream import get_limiter
+
+SPEECH_REGION = "switzerlandnorth"
+VOICE_NAME = "en-US-BrandonMultilingualNeural"
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+
+
+class SynthesizedAudio(NamedTuple):
+    audio: bytes
+    duration_ms: int
+    format: str  # file extension of the encoded audio, e.g. "mp3"
+
+
+class SpeechSynthesisError(Exception):
+    """A synthesis that failed, retried by the upstream layer unless the input itself was rejected."""
+
+    def __init__(self, message: str = "Speech synthesis failed", retryable: bool = True, overloaded: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.overloaded = overloaded
+
+
+class AzureSpeechBackend:
+    """Azure Speech synthesis through a reusable pool of in-memory synthesizers."""
+
+    format = "mp3"
+    output_format_name = "Audio24Khz48KBitRateMonoMp3"
+
+    def __init__(self, width: int = TTS_CONCURRENCY, language: str = "en-US", voice_name: str = VOICE_NAME):
+        import azure.cognitiveservices.speech as speechsdk
+
+        self.speechsdk = speechsdk
+        self.language = language
+        self.voice_name = voice_name
+
+        # Configure speech service
+        speech_config = speechsdk.SpeechConfig(subscription=os.getenv("SPEECH_KEY"), region=SPEECH_REGION)
+        speech_config.speech_synthesis_language = language
+        speech_config.speech_synthesis_voice_name = voice_name
+        speech_config.set_speech_synthesis_output_format(
+            getattr(speechsdk.SpeechSynthesisOutputFormat, self.output_format_name)
+        )
+
+        # audio_config=None keeps the synthesized audio in memory (result.audio_data)
+        self.pool = queue.Queue()
+        for _ in range(max(1, width)):
+            self.pool.put(speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None))
+
+    def synthesize(self, text: str) -> SynthesizedAudio:
+        speechsdk = self.speechsdk
+        synthesizer = self.pool.get()
+        try:
+            result = synthesizer.speak_text_async(text).get()
+        finally:
+            self.pool.put(synthesizer)
+
+        if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
+            duration_ms = int(result.audio_duration.total_seconds() * 1000)
+            return SynthesizedAudio(result.audio_data, duration_ms, self.format)
+
+        if result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = result.cancellation_details
+            print(f"Speech synthesis canceled: {cancellation_details.reason}")
+            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+                print(f"Error details: {cancellation_details.error_details}")
+                codes = speechsdk.CancellationErrorCode
+                code = cancellation_details.error_code
+                raise SpeechSynthesisError(
+                    retryable=code not in (codes.AuthenticationFailure, codes.BadRequest, codes.Forbidden),
+                    overloaded=code in (codes.TooManyRequests, codes.ServiceUnavailable, codes.ServiceTimeout),
+                )
+        raise SpeechSynthesisError()
+
+
+class StubSpeechBackend:
+    """Offline stand-in for Azure Speech producing a short tone per text.
+
+    The duration follows the word count, roughly like a real voice would. Latency and
+    a failure rate can be injected (STUB_SPEECH_LATENCY, STUB_SPEECH_ERROR_RATE) for load tests.
+    """
+
+    format = "wav"
+    output_format_name = "Riff16Khz16BitMonoPcm"
+    sample_rate = 16000
+
+    def __init__(
+        self,
+        language: str = "en-US",
+        voice_name: str = VOICE_NAME,
+        latency: float = None,
+        error_rate: float = None,
+        words_per_second: float = 2.5,
+    ):
+        self.language = language
+        self.voice_name = voice_name
+        self.latency = float(os.getenv("STUB_SPEECH_LATENCY", "0")) if latency is None else latency
+        self.error_rate = float(os.getenv("STUB_SPEECH_ERROR_RATE", "0")) if error_rate is None else error_rate
+        self.words_per_second = words_per_second
+
+    def synthesize(self, text: str) -> SynthesizedAudio:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise SpeechSynthesisError(overloaded=True)
+        duration_ms = max(1000, int(len(text.split()) / self.words_per_second * 1000))
+        n_samples = self.sample_rate * duration_ms // 1000
+        samples = (int(3000 * math.sin(2 * math.pi * 220 * i / self.sample_rate)) for i in range(n_samples))
+
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(struct.pack(f"<{n_samples}h", *samples))
+        return SynthesizedAudio(buffer.getvalue(), duration_ms, self.format)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_speech_backend(language: str = "en-US"):
+    """Return the process-wide speech backend, selected by SPEECH_BACKEND (azure or stub)."""
+    kind = os.getenv("SPEECH_BACKEND", "azure")
+    with _backends_lock:
+        if (kind, language) not in _backends:
+            if kind == "stub":
+                _backends[(kind, language)] = StubSpeechBackend(language=language)
+            else:
+                _backends[(kind, language)] = AzureSpeechBackend(language=language)
+        return _backends[(kind, language)]
+
+
+def speech_voice_id(language: str = "en-US") -> str:
+    """Identity of the voice get_speech_backend would use, without creating the backend."""
+    return f"{os.getenv('SPEECH_BACKEND', 'azure')}:{VOICE_NAME}:{language}"
+
+
+def synthesize_many(backend, texts: List[str], width: int = TTS_CONCURRENCY) -> List[SynthesizedAudio]:
+    """Synthesize texts concurrently, keeping the input order.
+
+    Calls go through the upstream limiter of the backend: failed syntheses are retried, and
+    a text already being synthesized by another job of this process is shared.
+    """
+    limiter = get_limiter("azure_speech" if isinstance(backend, AzureSpeechBackend) else "stub_speech")
+
+    def synthesize(text):
+        return limiter.run_sync(
+            lambda: backend.synthesize(text),
+            "synthesize",
+            backend.voice_name,
+            key=(backend.voice_name, backend.language, text),
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, min(width, len(texts) or 1))) as executor:
+        return list(executor.map(synthesize, texts))
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import threading
+from typing import List, Optional
+
+from disk_cache import DiskCache
+from openai_prompt import example
+from preprocess import VISION_IMAGE_FORMAT, VISION_IMAGE_MAX_SIZE, VISION_IMAGE_QUALITY
+from vision import (
+    VISION_MODEL,
+    VISION_WINDOW_OVERLAP,
+    VISION_WINDOW_SIZE,
+    build_upload_prompt,
+)
+
+UPLOAD_CACHE_DIR = os.getenv("UPLOAD_CACHE_DIR", "./output/upload_cache")
+UPLOAD_CACHE_MAX_BYTES = int(os.getenv("UPLOAD_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_CACHE_TTL = float(os.getenv("UPLOAD_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def upload_cache_key(images: List[bytes], additional_prompt: Optional[str], details: List[str], model: str = VISION_MODEL) -> str:
+    """Hash of everything that determines the instructions generated for an upload."""
+    payload = json.dumps(
+        {
+            "images": [hashlib.sha256(data).hexdigest() for data in images],
+            "prompt": build_upload_prompt(len(images), additional_prompt),
+            "example": example,
+            "model": model,
+            "details": details,
+            "preprocessing": [VISION_IMAGE_MAX_SIZE, VISION_IMAGE_FORMAT, VISION_IMAGE_QUALITY],
+            "windows": [VISION_WINDOW_SIZE, VISION_WINDOW_OVERLAP],
+        },
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class UploadCache(DiskCache):
+    """Persistent cache of the instructions generated for an uploaded image set."""
+
+    name = "upload"
+
+    def __init__(self, directory: str = UPLOAD_CACHE_DIR, max_bytes: int = UPLOAD_CACHE_MAX_BYTES, ttl: float = UPLOAD_CACHE_TTL):
+        super().__init__(directory, max_bytes, ttl=ttl)
+
+    def get(self, key: str) -> Optional[List[str]]:
+        entry = super().get(key)
+        if entry is None:
+            return None
+        return json.loads(entry[0])
+
+    def put(self, key: str, instructions: List[str]):
+        super().put(key, json.dumps(instructions, ensure_ascii=False).encode("utf-8"), suffix=".data")
+
+
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+
+def get_upload_cache() -> UploadCache:
+    """Return the process-wide upload cache."""
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = UploadCache()
+        return _upload_cache
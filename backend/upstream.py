@@ -0,0 +1,563 @@
+import asyncio
+import email.utils
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
+
+import httpx
+import openai
+
+from metrics import (
+    UPSTREAM_COALESCED,
+    UPSTREAM_CONCURRENCY_LIMIT,
+    UPSTREAM_RETRIES,
+    UPSTREAM_THROTTLE_SECONDS,
+    record_usage,
+    upstream_call,
+)
+
+T = TypeVar("T")
+
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "4"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+# Longest wait before a retry, a Retry-After beyond it fails the call instead of holding the request
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "30"))
+# Concurrent overload signals shrink the concurrency limit once, not once per failed call
+UPSTREAM_DECREASE_INTERVAL = float(os.getenv("UPSTREAM_DECREASE_INTERVAL", "1"))
+DEFAULT_MAX_CONCURRENCY = {"openai": 64, "bing": 16, "jina": 16, "azure_speech": 16, "stub_speech": 16}
+
+OVERLOAD_STATUS = {429, 503, 529}
+RETRY_STATUS = {408, 409, 500, 502, 504} | OVERLOAD_STATUS
+# Input tokens of an image, gpt-4o bills a 1024px image at high detail as 4 tiles
+IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+
+class Failure(NamedTuple):
+    retryable: bool
+    overloaded: bool  # the upstream asks for less traffic (429, 503, timeouts)
+    retry_after: Optional[float]
+    reason: str
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds to wait from the retry-after-ms or Retry-After (seconds or HTTP date) header."""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_failure(exc: BaseException) -> Failure:
+    """Whether a failed upstream call is worth retrying and whether it signals overload.
+
+    Errors of other clients can opt in with `retryable` and `overloaded` attributes.
+    """
+    if isinstance(exc, openai.APIStatusError):
+        status, response = exc.status_code, exc.response
+    elif isinstance(exc, httpx.HTTPStatusError):
+        status, response = exc.response.status_code, exc.response
+    elif isinstance(exc, (openai.APITimeoutError, httpx.TimeoutException, asyncio.TimeoutError)):
+        return Failure(True, True, None, "timeout")
+    elif isinstance(exc, (openai.APIConnectionError, httpx.TransportError)):
+        return Failure(True, False, None, "connection")
+    else:
+        return Failure(getattr(exc, "retryable", False), getattr(exc, "overloaded", False), None, type(exc).__name__)
+    return Failure(status in RETRY_STATUS, status in OVERLOAD_STATUS, parse_retry_after(response.headers), str(status))
+
+
+def backoff_delay(
+    attempt: int,
+    retry_after: Optional[float] = None,
+    base: float = UPSTREAM_BACKOFF_BASE,
+    cap: float = UPSTREAM_BACKOFF_MAX,
+) -> float:
+    """Exponential backoff with full jitter, never shorter than the Retry-After of the upstream."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def request_key(*parts) -> str:
+    """Key of a request from its JSON serializable parts, identical requests share it."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def estimate_tokens(messages: list, completion_tokens: int = 0) -> int:
+    """Rough token count of chat messages, about 4 characters per token.
+
+    Only used to reserve tokens-per-minute budget, the reservation is corrected with the
+    actual usage once the response arrives.
+    """
+    total = completion_tokens
+    for message in messages:
+        content = message.get("content") or ""
+        for part in [{"type": "text", "text": content}] if isinstance(content, str) else content:
+            if part.get("type") == "text":
+                total += len(part["text"]) // 4 + 1
+            elif part.get("type") == "image_url":
+                total += IMAGE_TOKENS.get(part["image_url"].get("detail", "auto"), IMAGE_TOKENS["high"])
+    return total
+
+
+class TokenBucket:
+    """Refills `per_minute` units every minute, up to a burst of one minute's worth. 0 means unlimited.
+
+    Callers reserve units up front and wait for the returned time, so concurrent callers
+    queue up behind each other instead of polling.
+    """
+
+    def __init__(self, per_minute: float = 0):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` units, return the seconds to wait until they are available."""
+        if not self.rate or not amount:
+            return 0.0
+        with self.lock:
+            self._refill()
+            self.level -= amount
+            return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount: float):
+        """Give back units reserved but not used, a negative amount charges more."""
+        if not self.rate or not amount:
+            return
+        with self.lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveConcurrency:
+    """Concurrency limit adjusted by AIMD from the outcome of each call.
+
+    Every success while the limit is in use raises it by 1/limit, about one per round of
+    calls, up to `maximum`. An overload signal halves it, down to `minimum`. Waiters are
+    woken in arrival order, from event loops or plain threads alike.
+    """
+
+    def __init__(self, name: str, maximum: int, minimum: int = 1, decrease_interval: float = UPSTREAM_DECREASE_INTERVAL):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(self.maximum)
+        self.decrease_interval = decrease_interval
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.waiters = deque()  # wake-up callbacks
+        self.lock = threading.Lock()
+        UPSTREAM_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    def _try_acquire(self, wake: Callable[[], None]) -> bool:
+        with self.lock:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            self.waiters.append(wake)
+            return False
+
+    def _wake_next(self):
+        with self.lock:
+            wake = self.waiters.popleft() if self.waiters else None
+        if wake is not None:
+            wake()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            woken = loop.create_future()
+
+            def wake(woken=woken):
+                loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+            if self._try_acquire(wake):
+                return
+            try:
+                await woken
+            except asyncio.CancelledError:
+                with self.lock:
+                    waiting = wake in self.waiters
+                    if waiting:
+                        self.waiters.remove(wake)
+                if not waiting:
+                    # Hand the wake-up on to the next waiter
+                    self._wake_next()
+                raise
+
+    def acquire_sync(self):
+        while True:
+            woken = threading.Event()
+            if self._try_acquire(woken.set):
+                return
+            woken.wait()
+
+    def release(self, outcome: str):
+        """Free a slot and adapt the limit, outcome is "success", "overload" or "error"."""
+        with self.lock:
+            self.in_flight -= 1
+            if outcome == "overload":
+                now = time.monotonic()
+                if now - self.last_decrease >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            elif outcome == "success" and self.in_flight + 1 >= int(self.limit):
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            limit = self.limit
+        UPSTREAM_CONCURRENCY_LIMIT.labels(self.name).set(limit)
+        self._wake_next()
+
+
+class UpstreamLimiter:
+    """Shared admission, retry and coalescing layer for the calls to one upstream.
+
+    A call waits for the requests and tokens per minute budgets and for a slot of the
+    adaptive concurrency limit, is retried with jittered exponential backoff on 429, 5xx,
+    timeouts and connection errors, and identical calls in flight share one upstream request.
+    A Retry-After only delays the call that got it, the halved concurrency limit already
+    slows down the others.
+
+    Usage:
+        limiter = get_limiter("openai")
+        response = await limiter.run(lambda: client.chat.completions.create(...), "improve_text", "gpt-4o")
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_concurrency: int = 64,
+        min_concurrency: int = 1,
+        max_attempts: int = UPSTREAM_MAX_ATTEMPTS,
+    ):
+        self.provider = provider
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(provider, max_concurrency, min_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.lock = threading.Lock()
+        self.shared = {}  # (event loop, key) -> [task, number of callers]
+        self.shared_sync = {}  # key -> Future
+
+    def _admission_delay(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def _outcome(self, exc: Optional[BaseException]) -> str:
+        if exc is None:
+            return "success"
+        return "overload" if classify_failure(exc).overloaded else "error"
+
+    @asynccontextmanager
+    async def slot(self, tokens: int = 0):
+        """Admit one attempt made by the caller, without retrying it."""
+        start = time.perf_counter()
+        delay = self._admission_delay(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.concurrency.acquire()
+        UPSTREAM_THROTTLE_SECONDS.labels(self.provider).observe(time.perf_counter() - start)
+        outcome = "error"
+        try:
+            yield
+            outcome = "success"
+        except Exception as e:
+            outcome = self._outcome(e)
+            # A failed attempt gives its tokens back, the retry reserves them again
+            self.tokens.refund(tokens)
+            raise
+        finally:
+            self.concurrency.release(outcome)
+
+    @contextmanager
+    def slot_sync(self, tokens: int = 0):
+        """Like slot, for calls made from plain threads."""
+        start = time.perf_counter()
+        delay = self._admission_delay(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        self.concurrency.acquire_sync()
+        UPSTREAM_THROTTLE_SECONDS.labels(self.provider).observe(time.perf_counter() - start)
+        outcome = "error"
+        try:
+            yield
+            outcome = "success"
+        except Exception as e:
+            outcome = self._outcome(e)
+            # A failed attempt gives its tokens back, the retry reserves them again
+            self.tokens.refund(tokens)
+            raise
+        finally:
+            self.concurrency.release(outcome)
+
+    def retry_delay(self, exc: Exception, attempt: int, operation: str) -> Optional[float]:
+        """Seconds to wait before retrying after the failed attempt number `attempt` (from 0), None to give up."""
+        failure = classify_failure(exc)
+        if not failure.retryable or attempt + 1 >= self.max_attempts:
+            return None
+        delay = backoff_delay(attempt, failure.retry_after)
+        if delay > UPSTREAM_BACKOFF_MAX:
+            return None
+        UPSTREAM_RETRIES.labels(self.provider, operation, failure.reason).inc()
+        print(f"{self.provider} {operation} failed ({failure.reason}), retrying in {delay:.2f}s")
+        return delay
+
+    def settle(self, model: str, tokens: int, usage):
+        """Correct a tokens-per-minute reservation with the `usage` of the response, and count its tokens."""
+        used = getattr(usage, "total_tokens", None)
+        if tokens and used is not None:
+            self.tokens.refund(tokens - used)
+        record_usage(model, usage, self.provider)
+
+    async def _call(self, fn: Callable[[], Awaitable[T]], operation: str, model: str, tokens: int) -> T:
+        with upstream_call(self.provider, operation, model):
+            attempt = 0
+            while True:
+                try:
+                    async with self.slot(tokens):
+                        result = await fn()
+                except Exception as e:
+                    delay = self.retry_delay(e, attempt, operation)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                self.settle(model, tokens, getattr(result, "usage", None))
+                return result
+
+    async def run(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        operation: str,
+        model: str = "",
+        tokens: int = 0,
+        key: Optional[Hashable] = None,
+    ) -> T:
+        """Call `fn` (a new request on every call) under the limits of the upstream, retrying transient failures.
+
+        Args:
+            fn (callable): Makes the request and returns its awaitable.
+            operation (str): Metrics label of the call.
+            model (str): Metrics label of the model, if any.
+            tokens (int): Estimated tokens, reserved from the tokens per minute budget.
+            key (hashable, optional): Calls with the same key in flight at the same time share one
+                request. The request is cancelled once every caller has gone.
+        """
+        if key is None:
+            return await self._call(fn, operation, model, tokens)
+
+        shared_key = (asyncio.get_running_loop(), key)
+        entry = self.shared.get(shared_key)
+        if entry is None:
+            entry = self.shared[shared_key] = [asyncio.ensure_future(self._call(fn, operation, model, tokens)), 0]
+            entry[0].add_done_callback(lambda _: self._unshare(shared_key, entry))
+        else:
+            UPSTREAM_COALESCED.labels(self.provider, operation).inc()
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                # Unshared first, a caller arriving now starts a new request instead of joining a cancelled one
+                self._unshare(shared_key, entry)
+                entry[0].cancel()
+
+    def _unshare(self, shared_key: tuple, entry: list):
+        if self.shared.get(shared_key) is entry:
+            del self.shared[shared_key]
+
+    def _call_sync(self, fn: Callable[[], T], operation: str, model: str, tokens: int) -> T:
+        with upstream_call(self.provider, operation, model):
+            attempt = 0
+            while True:
+                try:
+                    with self.slot_sync(tokens):
+                        result = fn()
+                except Exception as e:
+                    delay = self.retry_delay(e, attempt, operation)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                self.settle(model, tokens, getattr(result, "usage", None))
+                return result
+
+    def run_sync(
+        self,
+        fn: Callable[[], T],
+        operation: str,
+        model: str = "",
+        tokens: int = 0,
+        key: Optional[Hashable] = None,
+    ) -> T:
+        """Like run, for blocking calls made from threads (e.g. speech synthesis)."""
+        if key is None:
+            return self._call_sync(fn, operation, model, tokens)
+
+        with self.lock:
+            future = self.shared_sync.get(key)
+            owner = future is None
+            if owner:
+                future = self.shared_sync[key] = Future()
+        if not owner:
+            UPSTREAM_COALESCED.labels(self.provider, operation).inc()
+            return future.result()
+        try:
+            result = self._call_sync(fn, operation, model, tokens)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.shared_sync[key]
+
+    def stream(
+        self,
+        open_stream: Callable[[], AsyncContextManager],
+        operation: str,
+        model: str = "",
+        tokens: int = 0,
+        can_retry: Callable[[], bool] = lambda: True,
+    ) -> "UpstreamStream":
+        """Stream the events of a response under the limits of the upstream, retrying transient failures.
+
+        Failed attempts are retried as long as `can_retry` returns True, i.e. until the
+        caller has passed on output it cannot take back. After a retry the events start
+        over from the beginning of the new response.
+
+        Usage:
+            async with limiter.stream(lambda: client.beta.chat.completions.stream(...), "improve_text_stream",
+                                      "gpt-4o", tokens, can_retry=lambda: not sent) as events:
+                async for event in events:
+                    ...
+            completion = events.completion
+
+        Args:
+            open_stream (callable): Opens a new streamed response, an async context manager
+                iterating over its events and providing get_final_completion().
+            operation (str): Metrics label of the call.
+            model (str): Metrics label of the model, if any.
+            tokens (int): Estimated tokens, reserved from the tokens per minute budget.
+            can_retry (callable): Whether a failure may still be retried.
+        """
+        return UpstreamStream(self, open_stream, operation, model, tokens, can_retry)
+
+
+class UpstreamStream:
+    """Events of a streamed upstream response, see UpstreamLimiter.stream.
+
+    Leaving the `async with` block, also early or on cancellation, closes the upstream
+    connection. `completion` holds the final completion once every event has been read.
+    """
+
+    def __init__(
+        self,
+        limiter: UpstreamLimiter,
+        open_stream: Callable[[], AsyncContextManager],
+        operation: str,
+        model: str,
+        tokens: int,
+        can_retry: Callable[[], bool],
+    ):
+        self.limiter = limiter
+        self.open_stream = open_stream
+        self.operation = operation
+        self.model = model
+        self.tokens = tokens
+        self.can_retry = can_retry
+        self.completion = None
+        self.events = self._events()
+
+    async def _events(self) -> AsyncIterator:
+        limiter = self.limiter
+        with upstream_call(limiter.provider, self.operation, self.model):
+            attempt = 0
+            while True:
+                try:
+                    async with limiter.slot(self.tokens), self.open_stream() as stream:
+                        async for event in stream:
+                            yield event
+                        self.completion = await stream.get_final_completion()
+                    break
+                except Exception as e:
+                    delay = limiter.retry_delay(e, attempt, self.operation) if self.can_retry() else None
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        limiter.settle(self.model, self.tokens, getattr(self.completion, "usage", None))
+
+    def __aiter__(self) -> AsyncIterator:
+        return self.events
+
+    async def __aenter__(self) -> "UpstreamStream":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.events.aclose()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> UpstreamLimiter:
+    """Return the process-wide limiter of an upstream.
+
+    Configured with <PROVIDER>_RPM, <PROVIDER>_TPM (0 for unlimited), <PROVIDER>_MAX_CONCURRENCY
+    and <PROVIDER>_MIN_CONCURRENCY, e.g. OPENAI_TPM. The limits apply per process, with several
+    workers give each its share of the account quota.
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            prefix = provider.upper()
+            _limiters[provider] = UpstreamLimiter(
+                provider,
+                requests_per_minute=float(os.getenv(f"{prefix}_RPM", "0")),
+                tokens_per_minute=float(os.getenv(f"{prefix}_TPM", "0")),
+                max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", str(DEFAULT_MAX_CONCURRENCY.get(provider, 16)))),
+                min_concurrency=int(os.getenv(f"{prefix}_MIN_CONCURRENCY", "1")),
+            )
+        return _limiters[provider]
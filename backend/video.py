@@ -0,0 +1,165 @@
+import io
+import os
+import subprocess
+import threading
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+FFMPEG = os.getenv("FFMPEG_BINARY", "ffmpeg")
+# Only errors on stderr, no banner or progress lines
+FFMPEG_QUIET_ARGS = ["-hide_banner", "-loglevel", "error", "-nostats"]
+# Frames are letterboxed into the first image's size, capped to this box
+VIDEO_MAX_WIDTH = int(os.getenv("VIDEO_MAX_WIDTH", "1920"))
+VIDEO_MAX_HEIGHT = int(os.getenv("VIDEO_MAX_HEIGHT", "1080"))
+VIDEO_CODEC_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-tune", "stillimage", "-pix_fmt", "yuv420p"]
+AUDIO_CODEC_ARGS = ["-c:a", "aac", "-b:a", "128k"]
+# The closing copy of the last frame sits this long before the end of the video
+LAST_FRAME_PADDING = 0.04
+
+ImageSource = Union[bytes, str]
+
+
+def quote_concat_path(path: str) -> str:
+    # Quote for the concat demuxer: 'it'\''s' -> it's
+    return "'" + os.path.abspath(path).replace("'", "'\\''") + "'"
+
+
+def open_image(source: ImageSource) -> Image.Image:
+    """Open an image from its bytes or a file path, applying the EXIF rotation."""
+    image = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    return ImageOps.exif_transpose(image)
+
+
+def output_frame_size(source: ImageSource) -> Tuple[int, int]:
+    """Output frame size taken from an image, fit in the max box and rounded down to even dimensions for yuv420p."""
+    with open_image(source) as image:
+        width, height = image.size
+    scale = min(1.0, VIDEO_MAX_WIDTH / width, VIDEO_MAX_HEIGHT / height)
+    width, height = int(width * scale), int(height * scale)
+    return max(2, width - width % 2), max(2, height - height % 2)
+
+
+def letterbox_into(canvas: np.ndarray, source: ImageSource):
+    """Decode an image, fit it into the canvas preserving aspect ratio, and center it on black."""
+    height, width = canvas.shape[:2]
+    with open_image(source) as image:
+        image.draft("RGB", (width, height))
+        image = image.convert("RGB")
+        scale = min(width / image.width, height / image.height)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        pixels = np.asarray(image)
+    top = (height - pixels.shape[0]) // 2
+    left = (width - pixels.shape[1]) // 2
+    canvas.fill(0)
+    canvas[top:top + pixels.shape[0], left:left + pixels.shape[1]] = pixels
+
+
+def frame_timestamps_filter(offsets: List[float]) -> str:
+    """Filter placing input frame N at offsets[N] seconds, in a millisecond time base."""
+    terms = "+".join(f"eq(N,{idx})*{offset:.3f}" for idx, offset in enumerate(offsets) if offset)
+    return f"settb=1/1000,setpts=({terms or '0'})/TB"
+
+
+def run_ffmpeg(command: List[str]):
+    """Run an ffmpeg command and raise with its error output on failure."""
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace')[-2000:]}")
+
+
+def render_slideshow(
+    images: List[ImageSource],
+    durations: List[float],
+    audio_path: Optional[str],
+    output_path: str,
+    frame_size: Optional[Tuple[int, int]] = None,
+):
+    """Encode a slideshow of still images with its narration in a single ffmpeg pass.
+
+    Each image is decoded once, letterboxed into the output frame and piped to ffmpeg
+    as a single raw frame timestamped at the start of its page (variable frame rate),
+    so the cost scales with the number of pages, not with seconds of video, and no
+    intermediate image files are written.
+
+    Args:
+        images (list of bytes or str): The images, as encoded bytes or file paths.
+        durations (list of float): List of durations (in seconds) for each image.
+        audio_path (str, optional): Narration to mux into the video.
+        output_path (str): The file path where the output video will be saved.
+        frame_size (tuple of int, optional): Output (width, height), defaults to the first image.
+
+    Returns:
+        str: The output path.
+    """
+    if not images or len(images) != len(durations):
+        raise ValueError("The number of images must match the number of durations.")
+
+    width, height = frame_size or output_frame_size(images[0])
+    total = sum(durations)
+    offsets = [sum(durations[:idx]) for idx in range(len(durations))]
+    # A closing copy of the last frame makes the last page last until the end
+    offsets.append(max(offsets[-1], total - LAST_FRAME_PADDING))
+
+    command = [
+        FFMPEG, "-y", *FFMPEG_QUIET_ARGS,
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", "1", "-i", "pipe:0",
+    ]
+    if audio_path:
+        command += ["-i", audio_path]
+    command += ["-vf", f"{frame_timestamps_filter(offsets)},format=yuv420p", "-fps_mode", "vfr", *VIDEO_CODEC_ARGS]
+    if audio_path:
+        command += ["-map", "0:v:0", "-map", "1:a:0", *AUDIO_CODEC_ARGS]
+    command += ["-t", f"{total:.3f}", "-movflags", "+faststart", output_path]
+
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # stderr is drained while the frames are written, a full pipe would block ffmpeg and, in turn, the writes
+    stderr = []
+    drain = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    drain.start()
+    canvas = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        for source in images:
+            letterbox_into(canvas, source)
+            process.stdin.write(memoryview(canvas))
+        # The closing frame repeats the last image
+        process.stdin.write(memoryview(canvas))
+        process.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early, its error output is reported below
+    except BaseException:
+        process.kill()
+        process.wait()
+        drain.join()
+        raise
+    returncode = process.wait()
+    drain.join()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {b''.join(stderr).decode('utf-8', 'replace')[-2000:]}")
+    print(f"Video saved at {output_path}")
+    return output_path
+
+
+def concat_segments(paths: List[str], output_path: str):
+    """Join segments rendered with identical encoder settings, without re-encoding.
+
+    Args:
+        paths (list of str): Segment files in playback order, a file may appear several times.
+        output_path (str): The file path where the joined video will be saved.
+    """
+    list_path = f"{output_path}.ffconcat"
+    with open(list_path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        f.writelines(f"file {quote_concat_path(path)}\n" for path in paths)
+    try:
+        run_ffmpeg([
+            FFMPEG, "-y", *FFMPEG_QUIET_ARGS, "-f", "concat", "-safe", "0", "-i", list_path,
+            "-c", "copy", "-movflags", "+faststart", output_path,
+        ])
+    finally:
+        os.remove(list_path)
+    print(f"Video saved at {output_path}")
+    return output_path
@@ -0,0 +1,287 @@
+import asyncio
+import os
+from typing import AsyncIterator, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+
+from openai_prompt import example
+from preprocess import VisionImage, image_content_parts
+from schemas import Instructions
+from upstream import estimate_tokens, get_limiter, request_key
+
+VISION_MODEL = "gpt-4o"
+# Image sets larger than one window are split into overlapping windows analysed concurrently
+VISION_WINDOW_SIZE = int(os.getenv("VISION_WINDOW_SIZE", "10"))
+VISION_WINDOW_OVERLAP = int(os.getenv("VISION_WINDOW_OVERLAP", "2"))
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "8"))
+VISION_WINDOW_ATTEMPTS = 2
+# Expected output tokens per image, reserved from the tokens per minute budget
+VISION_COMPLETION_TOKENS = 200
+
+
+def build_upload_prompt(n_images: int, additional_prompt: Optional[str], start: int = 0, total: Optional[int] = None) -> str:
+    """Prompt asking for one markdown instruction per image."""
+    position = ""
+    if total is not None and total != n_images:
+        position = (f"These images are steps {start + 1} to {start + n_images} of a procedure with {total} steps in total, "
+                    f"describe only the steps shown here.\n    ")
+    return f"""I uploaded {n_images} images. These images provide visual instructions for assembling an object. Please analyze each image carefully and generate a clear, concise set of assembly instructions.
+    {position}For each image, provide the following description: Create a detailed instruction in Markdown format that describes what the user should do based on the visual information presented in the corresponding image.
+    Output Format: The response should be structured as a list, where each element is a string that contains the Markdown-formatted instruction for that particular image. IMPORTANT: 1 exact description per image. So the list should be of length {n_images}.
+
+    An example is provided below:
+
+    Input: 2 images of a paper airplane construction.
+    Output: list of lenght = 2 containing the description of each step. eg: {example}
+
+
+    Additional context that may be helpful: {additional_prompt}
+    """
+
+
+def plan_windows(n_images: int, size: int = VISION_WINDOW_SIZE, overlap: int = VISION_WINDOW_OVERLAP) -> List[Tuple[int, int]]:
+    """Split n_images into overlapping [start, end) windows of at most `size` images."""
+    size = max(1, size)
+    step = max(1, size - max(0, overlap))
+    windows = []
+    start = 0
+    while True:
+        end = min(start + size, n_images)
+        windows.append((start, end))
+        if end >= n_images:
+            return windows
+        start += step
+
+
+def owned_range(windows: List[Tuple[int, int]], k: int) -> Tuple[int, int]:
+    """Images whose description is taken from window k.
+
+    Images in an overlap are taken from the window where they sit further from the edge,
+    split at the middle of the overlap.
+    """
+    start, end = windows[k]
+    own_start = start if k == 0 else (start + windows[k - 1][1]) // 2
+    own_end = end if k == len(windows) - 1 else (windows[k + 1][0] + end) // 2
+    return own_start, own_end
+
+
+def vision_messages(prompt: str, vision_images: List[VisionImage]) -> List[dict]:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                *image_content_parts(vision_images),
+            ],
+        }
+    ]
+
+
+def stitch_windows(windows: List[Tuple[int, int]], results: List[List[str]]) -> List[str]:
+    """Merge per-window descriptions into exactly one description per image."""
+    instructions = []
+    for k, ((start, _), descriptions) in enumerate(zip(windows, results)):
+        own_start, own_end = owned_range(windows, k)
+        instructions.extend(descriptions[own_start - start:own_end - start])
+    return instructions
+
+
+async def describe_images(
+    client: AsyncOpenAI,
+    vision_images: List[VisionImage],
+    additional_prompt: Optional[str],
+    start: int = 0,
+    total: Optional[int] = None,
+) -> List[str]:
+    """Ask the vision model for one instruction per image, in a single call.
+
+    Raises:
+        ValueError: The model did not return one description per image.
+    """
+    prompt = build_upload_prompt(len(vision_images), additional_prompt, start, total)
+    print(prompt)
+
+    messages = vision_messages(prompt, vision_images)
+    limiter = get_limiter("openai")
+    last_error = None
+    for _ in range(VISION_WINDOW_ATTEMPTS):
+        # Make a call to OpenAI's API to get a description, identical uploads in flight share it
+        response = await limiter.run(
+            lambda: client.beta.chat.completions.parse(
+                model=VISION_MODEL,
+                messages=messages,
+                response_format=Instructions,
+            ),
+            "vision",
+            VISION_MODEL,
+            tokens=estimate_tokens(messages, VISION_COMPLETION_TOKENS * len(vision_images)),
+            key=request_key(VISION_MODEL, messages),
+        )
+        json_str = response.choices[0].message.parsed
+        if json_str is None:
+            last_error = "Failed to parse instructions from the response."
+        elif len(json_str.pages_instructions) != len(vision_images):
+            last_error = (f"Expected {len(vision_images)} instructions for images {start + 1}-{start + len(vision_images)}, "
+                          f"got {len(json_str.pages_instructions)}.")
+        else:
+            return json_str.pages_instructions
+        print(last_error)
+    raise ValueError(last_error)
+
+
+async def analyze_images(
+    client: AsyncOpenAI,
+    vision_images: List[VisionImage],
+    additional_prompt: Optional[str],
+    window_size: int = VISION_WINDOW_SIZE,
+    overlap: int = VISION_WINDOW_OVERLAP,
+    concurrency: int = VISION_CONCURRENCY,
+) -> List[str]:
+    """Generate one instruction per image, analysing large sets as concurrent overlapping windows.
+
+    Args:
+        client (AsyncOpenAI): The shared OpenAI client.
+        vision_images (list of VisionImage): The preprocessed images, in step order.
+        additional_prompt (str, optional): Extra context from the user.
+        window_size (int): Maximum number of images per model call.
+        overlap (int): Images shared by consecutive windows, giving each window context.
+        concurrency (int): Maximum number of windows analysed at the same time.
+
+    Returns:
+        list of str: Exactly one markdown instruction per image.
+    """
+    total = len(vision_images)
+    windows = plan_windows(total, window_size, overlap)
+    if len(windows) == 1:
+        return await describe_images(client, vision_images, additional_prompt)
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(start, end):
+        async with semaphore:
+            return await describe_images(client, vision_images[start:end], additional_prompt, start, total)
+
+    results = await asyncio.gather(*(bounded(start, end) for start, end in windows))
+    return stitch_windows(windows, results)
+
+
+def _partial_instructions(parsed) -> List[str]:
+    if parsed is None:
+        return []
+    if isinstance(parsed, dict):
+        return parsed.get("pages_instructions") or []
+    return getattr(parsed, "pages_instructions", None) or []
+
+
+async def stream_descriptions(
+    client: AsyncOpenAI,
+    vision_images: List[VisionImage],
+    additional_prompt: Optional[str],
+    start: int = 0,
+    total: Optional[int] = None,
+) -> AsyncIterator[Tuple[int, str]]:
+    """Yield (position in vision_images, description) as soon as each description is complete.
+
+    A list element is complete once the model has started the next one, the last one
+    when the response ends. Until the first description has been yielded, the call is
+    retried on transient failures and, like describe_images, when the model does not
+    return one description per image.
+
+    Raises:
+        ValueError: The model did not return one description per image.
+    """
+    prompt = build_upload_prompt(len(vision_images), additional_prompt, start, total)
+    messages = vision_messages(prompt, vision_images)
+    limiter = get_limiter("openai")
+    tokens = estimate_tokens(messages, VISION_COMPLETION_TOKENS * len(vision_images))
+    emitted = 0
+    for window_attempt in range(VISION_WINDOW_ATTEMPTS):
+        # Descriptions already sent cannot be taken back, only retry before the first one
+        async with limiter.stream(
+            lambda: client.beta.chat.completions.stream(
+                model=VISION_MODEL,
+                messages=messages,
+                response_format=Instructions,
+            ),
+            "vision_stream",
+            VISION_MODEL,
+            tokens,
+            can_retry=lambda: not emitted,
+        ) as events:
+            async for event in events:
+                if event.type != "content.delta":
+                    continue
+                descriptions = _partial_instructions(event.parsed)
+                while emitted < min(len(descriptions) - 1, len(vision_images)):
+                    yield emitted, descriptions[emitted]
+                    emitted += 1
+        completion = events.completion
+
+        json_str = completion.choices[0].message.parsed
+        descriptions = json_str.pages_instructions if json_str is not None else None
+        error = None
+        if descriptions is None:
+            error = "Failed to parse instructions from the response."
+        elif len(descriptions) != len(vision_images):
+            error = (f"Expected {len(vision_images)} instructions for images {start + 1}-{start + len(vision_images)}, "
+                     f"got {len(descriptions)}.")
+        if error is not None and not emitted and window_attempt + 1 < VISION_WINDOW_ATTEMPTS:
+            print(error)
+            continue
+        if descriptions is None:
+            raise ValueError(error)
+        while emitted < min(len(descriptions), len(vision_images)):
+            yield emitted, descriptions[emitted]
+            emitted += 1
+        if error is not None:
+            raise ValueError(error)
+        return
+
+
+async def iter_analyze_images(
+    client: AsyncOpenAI,
+    vision_images: List[VisionImage],
+    additional_prompt: Optional[str],
+    window_size: int = VISION_WINDOW_SIZE,
+    overlap: int = VISION_WINDOW_OVERLAP,
+    concurrency: int = VISION_CONCURRENCY,
+) -> AsyncIterator[Tuple[int, str]]:
+    """Like analyze_images, but yield (image index, description) pairs as they complete.
+
+    Pages arrive out of order when several windows run concurrently.
+    """
+    total = len(vision_images)
+    windows = plan_windows(total, window_size, overlap)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    queue = asyncio.Queue()
+    done = object()
+
+    async def run_window(k):
+        start, end = windows[k]
+        own_start, own_end = owned_range(windows, k)
+        try:
+            async with semaphore:
+                async for position, description in stream_descriptions(
+                    client, vision_images[start:end], additional_prompt, start, total if len(windows) > 1 else None
+                ):
+                    if own_start <= start + position < own_end:
+                        await queue.put((start + position, description))
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(done)
+
+    tasks = [asyncio.create_task(run_window(k)) for k in range(len(windows))]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,37 @@
+import asyncio
+import importlib
+import os
+import time
+from concurrent.futures import Executor
+from typing import Callable
+
+# Load the lazy modules in the gunicorn master, before the workers are forked (see gunicorn.conf.py)
+WARM_UP = os.getenv("WARM_UP", "false").lower() in ("1", "true", "yes")
+# Also start every pool process of each web worker at startup. The pools are sized per host
+# (their share of the CPUs, see WEB_CONCURRENCY), this trades idle memory for the first requests.
+WARM_UP_POOLS = os.getenv("WARM_UP_POOLS", "false").lower() in ("1", "true", "yes")
+# Modules the API only imports on first use
+LAZY_MODULES = ["numpy", "video"]
+
+
+def warm_up():
+    """Load the lazily imported video and speech stack ahead of the first request.
+
+    Only imports modules, it starts no threads and opens no connections, so it is safe
+    to call in the gunicorn master before the workers are forked.
+    """
+    start = time.perf_counter()
+    for name in LAZY_MODULES:
+        importlib.import_module(name)
+    if os.getenv("SPEECH_BACKEND", "azure") == "azure":
+        try:
+            import azure.cognitiveservices.speech  # noqa: F401
+        except ImportError as e:
+            print(f"Warm-up could not load the speech SDK: {e}")
+    print(f"Warm-up done in {time.perf_counter() - start:.2f}s")
+
+
+async def warm_up_pool(executor: Executor, workers: int, task: Callable = warm_up):
+    """Start the processes of a pool ahead of the first job, running `task` in them."""
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, task) for _ in range(workers)))
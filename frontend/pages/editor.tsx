@@ -20,17 +20,16 @@ interface VideoRequest {
     descriptions: string[];
 }
 
-interface VideoResponse {
-    video: string;         // base64 data URL of the video
-}
-const downloadBase64Video = (dataUrl: string, filename: string): void => {
+const downloadVideoBlob = (blob: Blob, filename: string): void => {
+    const url = URL.createObjectURL(blob);
     const link = document.createElement('a');
-    link.href = dataUrl;
+    link.href = url;
     link.download = filename;
 
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
+    URL.revokeObjectURL(url);
 };
 const generateAndDownloadVideo = async (
     images: string[],
@@ -52,10 +51,9 @@ const generateAndDownloadVideo = async (
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json() as VideoResponse;
-
-        // Download the video using the base64 data URL
-        downloadBase64Video(data.video, 'generated_video.mp4');
+        // The backend streams the mp4 file directly
+        const blob = await response.blob();
+        downloadVideoBlob(blob, 'generated_video.mp4');
 
     } catch (error) {
         console.error('Error:', error instanceof Error ? error.message : 'Unknown error');